@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+"""=================================================
+@Project -> File   ：tools -> __init__.py
+@IDE    : Pycharm
+@Author : Qi Shuo
+@Date   : 2020-3-9
+@Intro  : Submodules are imported lazily on first access, such as : ara.file_utils
+=================================================="""
+
+import importlib
+
+__all__ = [
+    "advancedDS",
+    "download_utils",
+    "file_utils",
+    "import_utils",
+    "kafka_utils",
+    "matrix_utils",
+    "print_utils",
+    "redis_utils",
+    "tf_keras_utils",
+]
+
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module("." + name, __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
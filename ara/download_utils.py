@@ -12,25 +12,29 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import requests
 import urllib.request
 
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
-from ara.print_utils import TqdmUpTo, SimpleProgressBar
+from ara.import_utils import LazyModule
+from ara.print_utils import TqdmUpTo, SimpleProgressBar, MultiWorkerProgress
 
+requests = LazyModule("requests")
 
-def download_image_task(url_list, path, task_id):
+
+def download_image_task(url_list, path, task_id, progress=None):
     """
     Download images task
     :param url_list: List of image urls
     :param path: Image download Path
     :param task_id: ID of the current task
+    :param progress: MultiWorkerProgress object shared by the tasks, None shows a progress bar per task
     :return: Status of Task
     """
-    url_list = SimpleProgressBar(url_list)
-    for url in url_list:
+    if progress is None:
+        url_list = SimpleProgressBar(url_list)
         url_list.show_title("task - {}".format(task_id))
+    for url in url_list:
         try:
             response = requests.get(url)
             response = response.content
@@ -38,6 +42,8 @@ def download_image_task(url_list, path, task_id):
                 f.write(response)
         except Exception as e:
             print(e)
+        if progress is not None:
+            progress.update()
     return "task-{}: {}".format(task_id, "done")
 
 
@@ -57,9 +63,11 @@ def download_images(image_urls, download_path, max_workers=1, data_slices=10):
     urls_list = [[] for _ in range(data_slices)]
     for i in range(len(image_urls)):
         urls_list[i % data_slices].append(image_urls[i])
-    all_task = [executor.submit(download_image_task, urls_list[j], download_path, j) for j in range(len(urls_list))]
-    for future in as_completed(all_task):
-        result = future.result()
+    with MultiWorkerProgress(total=len(image_urls), desc="Downloading") as progress:
+        all_task = [executor.submit(download_image_task, urls_list[j], download_path, j, progress)
+                    for j in range(len(urls_list))]
+        results = [future.result() for future in as_completed(all_task)]
+    for result in results:
         print(result)
 
 
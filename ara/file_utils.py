@@ -12,19 +12,167 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import io
 import os
 import sys
+import math
+import stat
+import uuid
+import codecs
+import locale
+import shutil
+import hashlib
+import tempfile
 import time
-import datetime
+import atexit
+import queue
+import threading
+import contextlib
 
-import pandas as pd
-import glob
+import fnmatch
 import json
 import logging
 import logging.handlers
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from ara.import_utils import LazyModule
 from ara.print_utils import SimpleProgressBar
 
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+
+try:
+    import orjson as fast_json
+except ImportError:
+    fast_json = None
+
+DEFAULT_CHUNK_SIZE = 65536
+
+# Changes with the layout of FileCache entries, older entries are never read
+FILE_CACHE_FORMAT = 2
+
+
+def _scan_dir(path):
+    """
+    List one directory with os.scandir
+    :param path: Directory path
+    :return: [List of file DirEntry, list of dir DirEntry]
+    """
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirs.append(entry)
+                else:
+                    files.append(entry)
+    except OSError as e:
+        print("\033[1;33;0mERROR : {}\033[0m".format(e))
+    return files, dirs
+
+
+def _walk_entries(path, recurse=False, max_workers=None):
+    """
+    Iteratively walk the directory tree, reusing the file type information of os.scandir
+    :param path: Input Path
+    :param recurse: Whether Recursive
+    :param max_workers: Max Workers of Thread Pool listing directories concurrently(for high latency filesystems).
+                        None lists directories one by one in the caller thread
+    :return: Generator of [DirEntry, whether it is a dir]
+    """
+    if max_workers is None or max_workers <= 1:
+        stack = [path]
+        while len(stack) > 0:
+            files, dirs = _scan_dir(stack.pop())
+            if recurse:
+                stack.extend(entry.path for entry in reversed(dirs))
+            for entry in files:
+                yield entry, False
+            for entry in dirs:
+                yield entry, True
+        return
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {executor.submit(_scan_dir, path)}
+    try:
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                if recurse:
+                    pending.update(executor.submit(_scan_dir, entry.path) for entry in dirs)
+                for entry in files:
+                    yield entry, False
+                for entry in dirs:
+                    yield entry, True
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _normalize_suffix(suffix):
+    if suffix is None:
+        return None
+    if not isinstance(suffix, (list, tuple, set)):
+        suffix = [suffix]
+    return tuple(".{}".format(ext.lstrip(".")).lower() for ext in suffix)
+
+
+def iter_files_from_path(path, recurse=False, full_path=True, suffix=None, pattern=None,
+                         min_size=None, max_size=None, max_workers=None):
+    """
+    Lazily get Files_Path From Input Path
+    :param path: Input Path
+    :param recurse: Whether Recursive
+    :param full_path: Full path flag, otherwise paths are relative to "path"
+    :param suffix: Suffix or list of suffixes, case-insensitive, such as : ['jpg', 'png']
+    :param pattern: Glob pattern matched against the file name, such as : 'img_*.jpg'
+    :param min_size: Minimum file size in bytes
+    :param max_size: Maximum file size in bytes
+    :param max_workers: Max Workers of Thread Pool listing directories concurrently
+    :return: Generator of Files_Path
+    """
+    if not os.path.exists(path):
+        return
+    suffix = _normalize_suffix(suffix)
+    prefix_length = len(os.path.join(path, ""))
+    for entry, is_dir in _walk_entries(path, recurse=recurse, max_workers=max_workers):
+        if is_dir:
+            continue
+        if suffix is not None and not entry.name.lower().endswith(suffix):
+            continue
+        if pattern is not None and not fnmatch.fnmatch(entry.name, pattern):
+            continue
+        if min_size is not None or max_size is not None:
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                continue
+            if (min_size is not None and size < min_size) or (max_size is not None and size > max_size):
+                continue
+        yield entry.path if full_path else entry.path[prefix_length:]
+
+
+def iter_dirs_from_path(path, recurse=False, pattern=None, max_workers=None):
+    """
+    Lazily get Dirs_Path From Input Path
+    :param path: Input Path
+    :param recurse: Whether Recursive
+    :param pattern: Glob pattern matched against the dir name
+    :param max_workers: Max Workers of Thread Pool listing directories concurrently
+    :return: Generator of Dirs_Path
+    """
+    if not os.path.exists(path):
+        return
+    for entry, is_dir in _walk_entries(path, recurse=recurse, max_workers=max_workers):
+        if is_dir and (pattern is None or fnmatch.fnmatch(entry.name, pattern)):
+            yield entry.path
+
 
 def get_files_from_path(path, recurse=False, full_path=True):
     """
@@ -34,22 +182,9 @@ def get_files_from_path(path, recurse=False, full_path=True):
     :param recurse: Whether Recursive
     :return: List of Files_Path
     """
-    files_path_list = []
-    if not os.path.exists(path):
-        return []
-    dir_list = SimpleProgressBar(os.listdir(path))
-    dir_list.show_title("Processing")
-    for file_path in dir_list:
-        if full_path:
-            file_path = os.path.join(path, file_path)
-        if os.path.isdir(file_path):
-            if recurse:
-                files_path_list += get_files_from_path(file_path, recurse=True)
-            else:
-                pass
-        else:
-            files_path_list.append(file_path)
-    return files_path_list
+    files_iter = SimpleProgressBar(iter_files_from_path(path, recurse=recurse, full_path=full_path))
+    files_iter.show_title("Processing")
+    return list(files_iter)
 
 
 def get_dirs_from_path(path, recurse=False):
@@ -59,37 +194,274 @@ def get_dirs_from_path(path, recurse=False):
     :param recurse: Whether Recursive
     :return: List of Dirs_Path
     """
-    dirs_path_list = []
-    if not os.path.exists(path):
-        return []
-    dir_list = SimpleProgressBar(os.listdir(path))
-    dir_list.show_title("Processing")
-    for each_dir in dir_list:
-        dir_path = os.path.join(path, each_dir)
-        if os.path.isdir(dir_path):
-            dirs_path_list.append(dir_path)
-            if recurse:
-                dirs_path_list += get_dirs_from_path(dir_path, recurse=True)
-    return dirs_path_list
+    dirs_iter = SimpleProgressBar(iter_dirs_from_path(path, recurse=recurse))
+    dirs_iter.show_title("Processing")
+    return list(dirs_iter)
+
 
+def _file_digest(file_path, hash_algorithm, block_size=1024 * 1024):
+    digest = hashlib.new(hash_algorithm)
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-def get_images_from_path(path, suffix=None):
+
+class FileManifest(object):
+    """FileManifest
+
+    Persistent record of the files seen under a path, used to process only what changed.
+        1.changes() yields the files added, modified or deleted since the last scan
+        2.save() after the changes are processed
+
+    A file is considered changed when its size or mtime changed. With hash_algorithm,
+    the content of those files is hashed too and files whose content is unchanged
+    are not reported. Unchanged files are never read.
+
+    Attributes:
+        manifest_path: JSON file the manifest is stored in
+        hash_algorithm: hashlib algorithm name, such as : 'md5', 'sha1'. None disables content hashing
+        records: Dict of absolute path -> [size, mtime_ns, digest]
     """
-    Get images from path
-    :param suffix: Image suffix list , such as : ['jpg', 'png', 'jpeg', 'JPG']
+
+    ADDED = "added"
+    MODIFIED = "modified"
+    DELETED = "deleted"
+
+    def __init__(self, manifest_path, hash_algorithm=None):
+        self.manifest_path = manifest_path
+        self.hash_algorithm = hash_algorithm
+        self.records = read_json_file_to_dict(manifest_path).get("files", {})
+
+    def changes(self, path, recurse=True, suffix=None, max_workers=None, update=True):
+        """
+        Scan the path and yield the changed files
+        :param path: Input Path
+        :param recurse: Whether Recursive
+        :param suffix: Suffix or list of suffixes, case-insensitive
+        :param max_workers: Max Workers of Thread Pool listing directories concurrently
+        :param update: Whether to record the scan result in the manifest
+        :return: Generator of [status, absolute file path], status is one of ADDED, MODIFIED, DELETED
+        """
+        if not os.path.exists(path):
+            return
+        # "tree", "./tree" and "/abs/tree" must share the records
+        path = os.path.abspath(path)
+        suffix = _normalize_suffix(suffix)
+        prefix = os.path.join(path, "")
+        seen = set()
+        for entry, is_dir in _walk_entries(path, recurse=recurse, max_workers=max_workers):
+            if is_dir or (suffix is not None and not entry.name.lower().endswith(suffix)):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            seen.add(entry.path)
+            record = self.records.get(entry.path)
+            if record is not None and record[0] == st.st_size and record[1] == st.st_mtime_ns:
+                continue
+            digest = None
+            if self.hash_algorithm is not None:
+                try:
+                    digest = _file_digest(entry.path, self.hash_algorithm)
+                except (IOError, OSError):
+                    continue
+            if update:
+                self.records[entry.path] = [st.st_size, st.st_mtime_ns, digest]
+            if record is None:
+                yield self.ADDED, entry.path
+            elif digest is None or digest != record[2]:
+                yield self.MODIFIED, entry.path
+        deleted = [file_path for file_path in self.records
+                   if file_path.startswith(prefix) and file_path not in seen
+                   and (suffix is None or file_path.lower().endswith(suffix))
+                   and (recurse or os.path.dirname(file_path) == os.path.dirname(prefix))]
+        for file_path in deleted:
+            if update:
+                del self.records[file_path]
+            yield self.DELETED, file_path
+
+    def save(self):
+        """
+        Write the manifest to manifest_path
+        :return: None
+        """
+        write_dict_to_json_file({"files": self.records}, self.manifest_path)
+
+
+IMAGE_MAGIC_NUMBERS = [
+    [b"\xff\xd8\xff", "jpeg"],
+    [b"\x89PNG\r\n\x1a\n", "png"],
+    [b"GIF87a", "gif"],
+    [b"GIF89a", "gif"],
+    [b"BM", "bmp"],
+    [b"II*\x00", "tiff"],
+    [b"MM\x00*", "tiff"],
+]
+
+
+def sniff_image_type(file_path):
+    """
+    Classify an image by its magic bytes, only the first 12 bytes are read
+    :param file_path: Input file path
+    :return: Image type, such as : 'jpeg', 'png'. None if not an image
+    """
+    try:
+        with open(file_path, "rb") as f:
+            head = f.read(12)
+    except (IOError, OSError):
+        return None
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    for magic, image_type in IMAGE_MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return image_type
+    return None
+
+
+def get_images_from_path(path, suffix=None, recurse=False, sniff=False, max_workers=None):
+    """
+    Get images from path in a single pass
+    :param suffix: Image suffix list(case-insensitive) , such as : ['jpg', 'png', 'jpeg']
     :param path: Input path
+    :param recurse: Whether Recursive
+    :param sniff: Whether to classify files with other or missing suffixes by their magic bytes
+    :param max_workers: Max Workers of Thread Pool listing directories concurrently
     :return: List of images
     """
     images_path_list = []
+    if not os.path.exists(path):
+        return []
     if suffix is None:
         suffix = ['jpg', 'png', 'jpeg', 'JPG']
-    for ext in suffix:
-        images_path_list.extend(glob.glob(
-            os.path.join(path, '*.{}'.format(ext))))
+    suffix = _normalize_suffix(suffix)
+    for entry, is_dir in _walk_entries(path, recurse=recurse, max_workers=max_workers):
+        # Hidden files are skipped like glob does
+        if is_dir or entry.name.startswith("."):
+            continue
+        if entry.name.lower().endswith(suffix) or (sniff and sniff_image_type(entry.path) is not None):
+            images_path_list.append(entry.path)
     return images_path_list
 
 
-def read_text_file_to_list(file_path, separator="\t", op=None):
+def _split_line(line, separator="\t", op=None):
+    """
+    Split one line by "separator" and operate on each element with "op"
+    :param line: Input text line
+    :param separator: Separator for each line
+    :param op: Operations on each element
+    :return: [Split data, Exception raised by "op" or None]
+    """
+    return _apply_op(line.strip().split(separator), op)
+
+
+def _apply_op(split_data, op=None):
+    """
+    Operate on each element of one split line with "op"
+    :param split_data: List of elements
+    :param op: Operations on each element
+    :return: [Operated data(the input if "op" failed), Exception raised by "op" or None]
+    """
+    if op is not None:
+        try:
+            split_data = list(map(op, split_data))
+        except Exception as e:
+            return split_data, e
+    return split_data, None
+
+
+def _rows_to_columns(rows, dtypes, row_numbers):
+    """
+    Convert a chunk of rows to a list of typed numpy column arrays
+    :param rows: List of split rows
+    :param dtypes: List of dtypes(one per column)
+    :param row_numbers: Line number of each row, used by error messages
+    :return: List of numpy.array()
+    """
+    width = len(dtypes)
+    good_rows, line_numbers = [], []
+    for row, line_number in zip(rows, row_numbers):
+        if len(row) != width:
+            print("\033[1;33;0mERROR : expected {} columns, got {} with line {}\033[0m".format(
+                width, len(row), line_number))
+        else:
+            good_rows.append(row)
+            line_numbers.append(line_number)
+    if len(good_rows) == 0:
+        return [np.array([], dtype=dtype) for dtype in dtypes]
+    columns = list(zip(*good_rows))
+    try:
+        return [np.array(column, dtype=dtype) for column, dtype in zip(columns, dtypes)]
+    except (ValueError, TypeError, OverflowError):
+        pass
+    # Some value cannot be converted, find the rows holding one, report and drop them
+    bad_rows = set()
+    for j, (column, dtype) in enumerate(zip(columns, dtypes)):
+        for i, value in enumerate(column):
+            try:
+                np.array([value], dtype=dtype)
+            except (ValueError, TypeError, OverflowError) as e:
+                if i not in bad_rows:
+                    print("\033[1;33;0mERROR : column {} {} with line {}\033[0m".format(j, e, line_numbers[i]))
+                bad_rows.add(i)
+    good_rows = [row for i, row in enumerate(good_rows) if i not in bad_rows]
+    if len(good_rows) == 0:
+        return [np.array([], dtype=dtype) for dtype in dtypes]
+    return [np.array(column, dtype=dtype) for column, dtype in zip(zip(*good_rows), dtypes)]
+
+
+def iter_text_file(file_path, separator="\t", op=None, chunk_size=None, dtypes=None, progress=False):
+    """
+    Lazily read the file contents, memory stays flat regardless of file size
+    Split by "separator"
+    Operate on each element with "op"
+    :param file_path: Input File Path
+    :param separator: Separator for each line
+    :param op: Operations on each element
+    :param chunk_size: Number of rows per chunk. None yields single rows
+    :param dtypes: numpy dtype or list of dtypes(one per column).
+                   If given, each chunk is yielded as a list of numpy column arrays and blank lines are skipped.
+                   A single dtype applies to every column of the first non-blank line
+    :param progress: Whether to show the progress bar
+    :return: Generator of rows(or chunks of rows)
+    """
+    if not os.path.exists(file_path):
+        return
+    if dtypes is not None and chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    with open(file_path, "r") as f:
+        file_iter = f
+        if progress:
+            file_iter = SimpleProgressBar(f)
+            file_iter.show_title("Reading file")
+        chunk = []
+        row_numbers = []
+        the_number_of_rows = 0
+        for line in file_iter:
+            the_number_of_rows += 1
+            if dtypes is not None and not line.strip():
+                continue
+            split_data, error = _split_line(line, separator, op)
+            if error is not None:
+                print("\033[1;33;0mERROR : {} with line {}\033[0m".format(error, the_number_of_rows))
+            if chunk_size is None:
+                yield split_data
+                continue
+            if dtypes is not None and not isinstance(dtypes, (list, tuple)):
+                # The width is fixed once for the whole file, so every chunk has the same columns
+                dtypes = [dtypes] * len(split_data)
+            chunk.append(split_data)
+            row_numbers.append(the_number_of_rows)
+            if len(chunk) == chunk_size:
+                yield chunk if dtypes is None else _rows_to_columns(chunk, dtypes, row_numbers)
+                chunk = []
+                row_numbers = []
+        if len(chunk) > 0:
+            yield chunk if dtypes is None else _rows_to_columns(chunk, dtypes, row_numbers)
+
+
+def read_text_file_to_list(file_path, separator="\t", op=None, cache=None):
     """
     Read the file contents to list
     Split by "separator"
@@ -97,42 +469,159 @@ def read_text_file_to_list(file_path, separator="\t", op=None):
     :param file_path: Input File Path
     :param separator: Separator for each line
     :param op: Operations on each element
+    :param cache: FileCache object, reuse the split lines parsed by earlier calls
     :return: List of file
     """
+    if cache is None:
+        return list(iter_text_file(file_path, separator=separator, op=op, progress=True))
+    if not os.path.exists(file_path):
+        return []
+    tag = ["text", separator, "utf-8"]
+    items = cache.get(file_path, tag)
+    if items is None:
+        split_data_list = list(iter_text_file(file_path, separator=separator, progress=True))
+        cache.put(file_path, tag, _pack_rows(split_data_list))
+    else:
+        split_data_list = _unpack_rows(items)
+    if op is None:
+        return split_data_list
+    for i, split_data in enumerate(split_data_list):
+        split_data_list[i], error = _apply_op(split_data, op)
+        if error is not None:
+            print("\033[1;33;0mERROR : {} with line {}\033[0m".format(error, i + 1))
+    return split_data_list
+
+
+def _pack_rows(rows):
+    """
+    Pack split lines into FileCache items: the cells joined by "\n" as one UTF-8 buffer, and the cell count
+    at the end of each row. Lines never contain "\n", and the size follows the text rather than the longest cell
+    :param rows: List of split lines
+    :return: List of [name, numpy.array()]
+    """
+    cells = "\n".join("\n".join(row) for row in rows if len(row) > 0)
+    return [["cells", np.frombuffer(cells.encode("utf-8"), dtype=np.uint8)],
+            ["row_ends", np.cumsum([len(row) for row in rows], dtype=np.int64)]]
+
+
+def _unpack_rows(items):
+    """
+    :param items: FileCache items from _pack_rows()
+    :return: List of split lines
+    """
+    arrays = dict(items)
+    row_ends = arrays["row_ends"].tolist()
+    # Decoded straight from the memory-mapped buffer, without copying it to bytes first
+    cells = codecs.utf_8_decode(arrays["cells"])[0].split("\n") if len(row_ends) and row_ends[-1] else []
+    return [cells[start:end] for start, end in zip([0] + row_ends[:-1], row_ends)]
+
+
+def _split_file_offsets(file_path, parts):
+    """
+    Split the file into "parts" byte ranges aligned to line starts
+    :param file_path: Input File Path
+    :param parts: Number of byte ranges
+    :return: List of [start, end] byte offsets
+    """
+    file_size = os.path.getsize(file_path)
+    offsets = [0]
+    with open(file_path, "rb") as f:
+        for i in range(1, parts):
+            f.seek(max(file_size * i // parts, offsets[-1]))
+            f.readline()
+            position = f.tell()
+            if position >= file_size:
+                break
+            if position > offsets[-1]:
+                offsets.append(position)
+    offsets.append(file_size)
+    return [[offsets[i], offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def _read_text_range(file_path, start, end, separator="\t", op=None, encoding=None):
+    """
+    Parse the lines of one byte range of the file(run in worker processes)
+    :param file_path: Input File Path
+    :param start: Start byte offset
+    :param end: End byte offset
+    :param separator: Separator for each line
+    :param op: Operations on each element
+    :param encoding: Text encoding of the file
+    :return: [List of rows, number of lines, list of [local line number, error message]]
+    """
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
     split_data_list = []
+    errors = []
+    the_number_of_rows = 0
+    for line in io.TextIOWrapper(io.BytesIO(data), encoding=encoding):
+        the_number_of_rows += 1
+        split_data, error = _split_line(line, separator, op)
+        if error is not None:
+            errors.append([the_number_of_rows, "{}".format(error)])
+        split_data_list.append(split_data)
+    return split_data_list, the_number_of_rows, errors
+
+
+def read_text_file_to_list_parallel(file_path, separator="\t", op=None, max_workers=None, encoding=None):
+    """
+    Read the file contents to list with multiple processes
+    The file is split at line boundaries and each range is parsed in a process pool,
+    results are merged in file order. "op" must be picklable(e.g. not a lambda)
+    :param file_path: Input File Path
+    :param separator: Separator for each line
+    :param op: Operations on each element
+    :param max_workers: Max Workers of Process Pool, default is the number of CPUs
+    :param encoding: Text encoding of the file, default is the locale encoding like open()
+    :return: List of file
+    """
     if not os.path.exists(file_path):
         return []
-    with open(file_path, "r") as f:
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+    ranges = _split_file_offsets(file_path, max_workers * 4)
+    split_data_list = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        all_task = [executor.submit(_read_text_range, file_path, start, end, separator, op, encoding)
+                    for start, end in ranges]
         the_number_of_rows = 0
-        file_iter = SimpleProgressBar(f)
-        file_iter.show_title("Reading file")
-        for _, line in enumerate(file_iter):
-            the_number_of_rows += 1
-            split_data = line.strip().split(separator)
-            if op is not None:
-                try:
-                    split_data = list(map(op, split_data))
-                except Exception as e:
-                    print("\033[1;33;0mERROR : {} with line {}\033[0m".format(e, the_number_of_rows))
-                else:
-                    pass
-            split_data_list.append(split_data)
+        for future in all_task:
+            rows, number_of_rows, errors = future.result()
+            for line_number, error in errors:
+                print("\033[1;33;0mERROR : {} with line {}\033[0m".format(error, the_number_of_rows + line_number))
+            the_number_of_rows += number_of_rows
+            split_data_list.extend(rows)
     return split_data_list
 
 
-def read_excel_file_to_dict(file_path, sheet_name=None, op=None):
+def read_excel_file_to_dict(file_path, sheet_name=None, op=None, cache=None):
     """
     Read the excel file contents to dict(multi sheet)
     :param file_path: Excel file path
     :param sheet_name: Sheet name list
     :param op: Operations on each element
+    :param cache: FileCache object, reuse the sheets parsed by earlier calls. Files with a column mixing text
+        and other values are not cached
     :return: Dict of excel file
     """
     excel_data_dict = {}
     if not os.path.exists(file_path):
         return {}
-    sheet = pd.read_excel(file_path, sheet_name=sheet_name)
-    for name, value in sheet.items():
+    items = None
+    tag = ["excel", sheet_name]
+    if cache is not None:
+        items = cache.get(file_path, tag)
+    if items is None:
+        sheets = list(pd.read_excel(file_path, sheet_name=sheet_name).items())
+        items = None if cache is None else _pack_sheets(sheets)
+        if items is not None:
+            cache.put(file_path, tag, items)
+    else:
+        sheets = _unpack_sheets(items)
+    for name, value in sheets:
         excel_data_list = value.values.tolist()
         if op is not None:
             try:
@@ -145,6 +634,285 @@ def read_excel_file_to_dict(file_path, sheet_name=None, op=None):
     return excel_data_dict
 
 
+def _pack_sheets(sheets):
+    """
+    Pack sheets into FileCache items without pickle: numeric and datetime columns as they are,
+    text columns as one UTF-8 buffer with the byte end of each cell and a missing mask
+    :param sheets: List of (name, DataFrame or Series) from pandas.read_excel()
+    :return: List of [name, numpy.array()], None if a sheet name or a column can not be stored this way
+    """
+    items = []
+    for name, value in sheets:
+        if type(name) not in (str, int, float):
+            return None
+        kind = "series" if isinstance(value, pd.Series) else "frame"
+        frame = value.to_frame() if kind == "series" else value
+        items.append([[name, -1, kind], np.array([len(frame)], dtype=np.int64)])
+        for i in range(frame.shape[1]):
+            column = frame.iloc[:, i]
+            if isinstance(column.dtype, np.dtype) and column.dtype.kind in "biufcmM":
+                items.append([[name, i, "values"], column.to_numpy()])
+                continue
+            missing = column.isna().to_numpy()
+            cells = column[~missing].tolist()
+            if not all(isinstance(cell, str) for cell in cells):
+                # e.g. text mixed with numbers
+                return None
+            cells = [cell.encode("utf-8") for cell in cells]
+            items.append([[name, i, "missing"], missing])
+            items.append([[name, i, "ends"], np.cumsum([len(cell) for cell in cells], dtype=np.int64)])
+            items.append([[name, i, "cells"], np.frombuffer(b"".join(cells), dtype=np.uint8)])
+    return items
+
+
+def _unpack_sheets(items):
+    """
+    :param items: FileCache items from _pack_sheets()
+    :return: List of (name, DataFrame or Series), with the column dtypes read_excel() returned
+    """
+    sheets = []
+    for (name, i, part), array in items:
+        if i < 0:
+            sheets.append([name, part, int(array[0]), {}])
+        else:
+            sheets[-1][3].setdefault(i, {})[part] = array
+    unpacked = []
+    for name, kind, number_of_rows, parts in sheets:
+        columns = []
+        for i in range(len(parts)):
+            if "values" in parts[i]:
+                columns.append(np.asarray(parts[i]["values"]))
+                continue
+            ends = parts[i]["ends"].tolist()
+            buffer = parts[i]["cells"]
+            column = np.full(number_of_rows, np.nan, dtype=object)
+            column[~parts[i]["missing"]] = [codecs.utf_8_decode(buffer[start:end])[0]
+                                            for start, end in zip([0] + ends[:-1], ends)]
+            columns.append(column)
+        if kind == "series":
+            unpacked.append((name, pd.Series(columns[0])))
+        else:
+            unpacked.append((name, pd.DataFrame(dict(enumerate(columns)), index=range(number_of_rows))))
+    return unpacked
+
+
+class FileCache(object):
+    """FileCache
+
+    On-disk cache of parsed files.
+        Entries are keyed on (path, mtime, size, reader arguments) and stored as
+        .npy files, memory-mapped on load. Object arrays are refused, nothing is
+        pickled, so loading an entry never runs code. Whoever can write to
+        cache_dir can still change the data read back, keep it private.
+        The least recently used entries are evicted when the total size exceeds max_bytes.
+
+    Attributes:
+        cache_dir: Cache directory
+        max_bytes: Limit on the total size of the cache
+        hits: Number of cache hits
+        misses: Number of cache misses
+        evictions: Number of evicted entries
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _key(self, file_path, tag):
+        st = os.stat(file_path)
+        key = json.dumps([FILE_CACHE_FORMAT, os.path.abspath(file_path), st.st_mtime_ns, st.st_size, tag])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, file_path, tag):
+        """
+        Load a cached entry
+        :param file_path: Source file path
+        :param tag: JSON serializable reader arguments
+        :return: List of [name, numpy.array()], None if missed
+        """
+        entry_dir = os.path.join(self.cache_dir, self._key(file_path, tag))
+        try:
+            with open(os.path.join(entry_dir, "meta.json"), "r") as f:
+                meta = json.load(f)
+            items = []
+            for i, name in enumerate(meta["items"]):
+                array_path = os.path.join(entry_dir, "{}.npy".format(i))
+                items.append([name, np.load(array_path, mmap_mode="r", allow_pickle=False)])
+            os.utime(entry_dir, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return items
+
+    def put(self, file_path, tag, items):
+        """
+        Store an entry, then evict old entries if the cache is too large
+        :param file_path: Source file path
+        :param tag: JSON serializable reader arguments
+        :param items: List of [name, numpy.array()], names are JSON serializable and arrays are not object arrays
+        :return: None
+        """
+        if any(np.asarray(array).dtype.hasobject for _, array in items):
+            raise ValueError("FileCache Error! Object arrays can not be cached")
+        entry_dir = os.path.join(self.cache_dir, self._key(file_path, tag))
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+        meta = {"source": os.path.abspath(file_path), "items": []}
+        for i, (name, array) in enumerate(items):
+            np.save(os.path.join(tmp_dir, "{}.npy".format(i)), array, allow_pickle=False)
+            meta["items"].append(name)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            entries.append([os.path.getmtime(entry_dir), size, entry_dir])
+        return entries
+
+    def size(self):
+        """
+        :return: Total size of the cache in bytes
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        :return: None
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all entries
+        :return: None
+        """
+        for _, _, entry_dir in self._entries():
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def stats(self):
+        """
+        :return: Dict of cache statistics
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": self.size(), "max_bytes": self.max_bytes}
+
+
+def _json_loads(data):
+    """
+    Parse json with the fast backend if installed, falling back to json for what it rejects(e.g. NaN)
+    :param data: Json str or bytes
+    :return: Python object
+    """
+    if fast_json is not None:
+        try:
+            return fast_json.loads(data)
+        except ValueError:
+            pass
+    return json.loads(data)
+
+
+def _has_non_finite(obj):
+    """
+    :param obj: Python object
+    :return: Whether a float key or value nested in obj is NaN or infinite
+    """
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(key) or _has_non_finite(value) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    return False
+
+
+def _json_encode(obj):
+    """
+    Serialize one object to json bytes with the fast backend
+    :param obj: Python object
+    :return: Json bytes, None if the fast backend is not installed or would not write what json writes
+    """
+    if fast_json is None:
+        return None
+    try:
+        data = fast_json.dumps(obj, option=fast_json.OPT_NON_STR_KEYS)
+    except TypeError:
+        return None
+    # The fast backend writes NaN and Infinity as null, the object is only walked when null is in the output
+    if b"null" in data and _has_non_finite(obj):
+        return None
+    return data
+
+
+def _json_dumps(obj):
+    """
+    Serialize one object to a single line json str, non-finite floats are written as NaN/Infinity like json
+    :param obj: Python object
+    :return: Json str
+    """
+    data = _json_encode(obj)
+    return json.dumps(obj) if data is None else data.decode("utf-8")
+
+
+@contextlib.contextmanager
+def atomic_write(out_file_path, mode="w", encoding=None):
+    """
+    Open a temp file next to "out_file_path" and rename it over the target on success,
+    so readers never see a truncated file
+    :param out_file_path: Output file path
+    :param mode: File mode, "w" or "wb"
+    :param encoding: Text encoding
+    :return: File object
+    """
+    out_dir = os.path.dirname(os.path.abspath(out_file_path))
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    while True:
+        tmp_path = os.path.join(out_dir, ".{}.{}.tmp".format(os.path.basename(out_file_path), uuid.uuid4().hex[:12]))
+        try:
+            # 0o666 like open(), the process umask applies
+            fd = os.open(tmp_path, flags, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with io.open(fd, mode, encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            # Replacing keeps the permissions of the existing file
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(out_file_path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, out_file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
 def read_json_file_to_dict(file_path):
     """
     Read json file to dict
@@ -153,28 +921,224 @@ def read_json_file_to_dict(file_path):
     """
     if not os.path.exists(file_path):
         return {}
-    with open(file_path, "r") as json_file:
-        data = json_file.read()
-        return json.loads(data)
+    with open(file_path, "rb") as json_file:
+        return _json_loads(json_file.read())
 
 
-def write_dict_to_json_file(in_dict, out_file_path):
+def write_dict_to_json_file(in_dict, out_file_path, atomic=True, stream=False):
     """
     Write dict to json file
     :param in_dict: Input Dict data
     :param out_file_path: Output json file path
+    :param atomic: Whether to write through a temp file and rename
+    :param stream: Serialize incrementally so the whole json str is never held in memory(slower)
     :return: None
     """
-    with open(out_file_path, "w") as json_file:
-        json_file.write(json.dumps(in_dict))
+    # The fast backend writes bytes directly, the json fallback builds a str and encodes it
+    data = None if stream else _json_encode(in_dict)
+    mode = "w" if data is None else "wb"
+    with (atomic_write(out_file_path, mode) if atomic else open(out_file_path, mode)) as json_file:
+        if data is not None:
+            json_file.write(data)
+        elif stream:
+            json.dump(in_dict, json_file)
+        else:
+            json_file.write(json.dumps(in_dict))
+
+
+def iter_json_lines(file_path):
+    """
+    Lazily read a JSON Lines file, blank lines are skipped
+    :param file_path: JSON Lines file path
+    :return: Generator of Python objects
+    """
+    if not os.path.exists(file_path):
+        return
+    with open(file_path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield _json_loads(line)
+
+
+def write_json_lines(records, out_file_path, append=False):
+    """
+    Write objects to a JSON Lines file one by one
+    :param records: Iterable of Python objects
+    :param out_file_path: Output file path
+    :param append: Append to the file, otherwise the file is replaced atomically
+    :return: Number of written objects
+    """
+    number_of_records = 0
+    with (open(out_file_path, "a", encoding="utf-8") if append
+          else atomic_write(out_file_path, "w", encoding="utf-8")) as f:
+        for record in records:
+            f.write(_json_dumps(record))
+            f.write("\n")
+            number_of_records += 1
+    return number_of_records
+
+
+def iter_json_array(file_path, block_size=1024 * 1024):
+    """
+    Lazily parse the elements of a large top-level json array
+    :param file_path: Json file path
+    :param block_size: Bytes read at a time
+    :return: Generator of Python objects
+    """
+    if not os.path.exists(file_path):
+        return
+    decoder = json.JSONDecoder()
+    with open(file_path, "r", encoding="utf-8") as f:
+        buffer = f.read(block_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError("Top-level json value is not an array!")
+        position = 1
+        eof = False
+        read_size = block_size
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                if position == len(buffer):
+                    raise ValueError("Need more data")
+                obj, end = decoder.raw_decode(buffer, position)
+                # A number at the end of the buffer may continue in the next block
+                if end == len(buffer) and not eof:
+                    raise ValueError("Need more data")
+            except ValueError:
+                if eof:
+                    raise
+                block = f.read(read_size)
+                eof = len(block) == 0
+                buffer = buffer[position:] + block
+                position = 0
+                # Grow reads for elements larger than a block
+                read_size *= 2
+                continue
+            read_size = block_size
+            yield obj
+            position = end
+            if position > block_size:
+                buffer = buffer[position:]
+                position = 0
+
+
+class AsyncHandler(logging.Handler):
+    """AsyncHandler
+
+    Moves log I/O off the caller thread.
+        Records are put on a bounded queue and a background thread writes them
+        to the wrapped handlers in batches, stream handlers are flushed once per batch.
+
+    Attributes:
+        handlers: Wrapped handlers
+        queue: Bounded record queue
+        batch_size: Maximum number of records written per batch
+        block: Whether callers block when the queue is full, otherwise the record is dropped
+        dropped: Number of dropped records
+    """
+
+    def __init__(self, handlers, queue_size=10000, batch_size=256, block=True):
+        super(AsyncHandler, self).__init__()
+        self.handlers = handlers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.block = block
+        self.dropped = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop, name="AsyncHandler")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        try:
+            # Render the message now, the arguments may change before the writer runs
+            record.msg = record.getMessage()
+            record.args = None
+            self.queue.put(record, block=self.block)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _write_loop(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = records[-1] is None
+            if stop:
+                records.pop()
+            try:
+                self._write_batch(records)
+            finally:
+                for _ in range(len(records) + int(stop)):
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _write_batch(self, records):
+        for handler in self.handlers:
+            records_to_write = [record for record in records
+                                if record.levelno >= handler.level and handler.filter(record)]
+            if len(records_to_write) == 0:
+                continue
+            if type(handler) in (logging.StreamHandler, logging.FileHandler) and handler.stream is not None:
+                handler.acquire()
+                try:
+                    for record in records_to_write:
+                        try:
+                            handler.stream.write(handler.format(record) + handler.terminator)
+                        except Exception:
+                            handler.handleError(record)
+                    handler.flush()
+                finally:
+                    handler.release()
+            else:
+                for record in records_to_write:
+                    handler.handle(record)
+
+    def flush(self):
+        """
+        Wait until all queued records are written
+        :return: None
+        """
+        if not self._closed:
+            self.queue.join()
+
+    def close(self):
+        """
+        Write the remaining records, stop the writer thread and close the wrapped handlers
+        :return: None
+        """
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        self._thread.join()
+        for handler in self.handlers:
+            handler.close()
+        super(AsyncHandler, self).close()
 
 
 class Logger(object):
 
-    def __init__(self, file_path, name="logger"):
+    def __init__(self, file_path, name="logger", async_mode=False, queue_size=10000, block=True):
         """
         Initialize the log class
         :param file_path: Log file path
+        :param name: Logger name
+        :param async_mode: Whether to write the log in a background thread
+        :param queue_size: Max records waiting to be written in async mode
+        :param block: Whether to block when the queue is full in async mode, otherwise drop the record
         """
         self.logger = logging.getLogger(name)
         handler = logging.FileHandler(filename=file_path)
@@ -182,7 +1146,20 @@ class Logger(object):
         handler.setLevel(logging.INFO)
         formatter = logging.Formatter('%(message)s')
         handler.setFormatter(formatter)
+        if async_mode:
+            handler = AsyncHandler([handler], queue_size=queue_size, block=block)
+        self.handler = handler
         self.logger.addHandler(handler)
+        # (second, formatted second), shared by threads so it is replaced as a whole
+        self._time_cache = (None, "")
+
+    def _format_time(self, timestamp):
+        second = int(timestamp)
+        time_cache = self._time_cache
+        if time_cache[0] != second:
+            time_cache = (second, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second)))
+            self._time_cache = time_cache
+        return "{}.{:06d}".format(time_cache[1], int((timestamp - second) * 1000000))
 
     def out_print(self, line, with_time=False):
         """
@@ -192,17 +1169,27 @@ class Logger(object):
         :return: None
         """
         if with_time:
-            date_str = datetime.datetime.fromtimestamp(time.time()).strftime("%Y-%m-%d %H:%M:%S.%f")
-            self.logger.info("{} | {}".format(date_str, line))
+            self.logger.info("{} | {}".format(self._format_time(time.time()), line))
         else:
             self.logger.info("{}".format(line))
 
+    def close(self):
+        """
+        Flush and close the log file
+        :return: None
+        """
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
 
-def error_logger(log_path, name):
+def error_logger(log_path, name, async_mode=False, queue_size=10000, block=True):
     """
     formatting error log
     :param log_path: error log path
     :param name: log name
+    :param async_mode: Whether to write the log in a background thread
+    :param queue_size: Max records waiting to be written in async mode
+    :param block: Whether to block when the queue is full in async mode, otherwise drop the record
     :return: Logger
     """
     logger = logging.getLogger(name)
@@ -229,8 +1216,11 @@ def error_logger(log_path, name):
     )
     error_handler.setLevel(logging.ERROR)
 
-    logger.addHandler(console_handler)
-    logger.addHandler(error_handler)
+    if async_mode:
+        logger.addHandler(AsyncHandler([console_handler, error_handler], queue_size=queue_size, block=block))
+    else:
+        logger.addHandler(console_handler)
+        logger.addHandler(error_handler)
     logger.propagate = False
     return logger
 
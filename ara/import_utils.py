@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""=================================================
+@Project -> File   ：tools -> import_utils.py
+@IDE    : Pycharm
+@Author : Qi Shuo
+@Date   : 2020-3-9
+@Intro  : Import Tools
+=================================================="""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import types
+import importlib
+import threading
+
+_import_lock = threading.Lock()
+
+
+class LazyModule(types.ModuleType):
+    """LazyModule
+
+    Module placeholder which imports the real module on first attribute access,
+    so heavy dependencies are only loaded by the functions that use them.
+        np = LazyModule("numpy")
+        np.zeros(3)  # numpy is imported here
+
+    Attributes:
+        name: Full name of the module
+    """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            with _import_lock:
+                module = self.__dict__["_module"]
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__["_module"] is None:
+            return "<lazy module '{}' (not loaded)>".format(self.__name__)
+        return repr(self.__dict__["_module"])
+
+    def __reduce__(self):
+        return LazyModule, (self.__name__,)
+
+
+def is_loaded(name):
+    """
+    Whether the module has been imported
+    :param name: Full name of the module
+    :return: Bool
+    """
+    return name in sys.modules
+
+
+if __name__ == "__main__":
+    pass
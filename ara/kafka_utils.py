@@ -12,9 +12,198 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import sys
+import zlib
+import time
+import bisect
+import pickle
+import itertools
+import threading
+import multiprocessing
+import multiprocessing.connection
 from abc import abstractmethod
-from kafka import KafkaConsumer, KafkaProducer
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+
+from ara.import_utils import LazyModule
+
+kafka = LazyModule("kafka")
+
+CONSUMER_MODES = ("inline", "pipelined", "process")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: [type, label names, help]
+METRICS = {
+    "consumer_records_total": ["counter", ("topic", "partition"), "Records polled"],
+    "consumer_bytes_total": ["counter", ("topic", "partition"), "Serialized key and value bytes polled"],
+    "consumer_lag": ["gauge", ("topic", "partition"), "Highwater offset minus the next offset to poll"],
+    "consumer_queue_depth": ["gauge", (), "Batches waiting or processing"],
+    "consumer_batch_errors_total": ["counter", (), "Batches whose processing raised"],
+    "consumer_poll_to_process_seconds": ["histogram", (), "From the first record of a batch polled to processing"],
+    "consumer_process_seconds": ["histogram", (), "Duration of process_batch()"],
+    "producer_records_total": ["counter", ("topic",), "Records acknowledged"],
+    "producer_bytes_total": ["counter", ("topic",), "Key and value bytes acknowledged"],
+    "producer_errors_total": ["counter", ("topic",), "Records failed"],
+    "producer_pending": ["gauge", (), "Records sent and not acknowledged yet"],
+    "producer_send_seconds": ["histogram", (), "From send() to acknowledgement"],
+}
+
+
+class KafkaMetrics(object):
+    """Counters, gauges and latency histograms of the runners
+
+    Updated once per poll/batch on the consumer side and once per message on
+    the producer side, under a single lock. Label values are tuples ordered
+    as in METRICS, e.g. ("topic", 0) for a partition.
+
+    Attributes:
+        callback: Callable(snapshot dict) called every interval seconds from
+            the thread updating the metrics, None to disable
+        interval: Seconds between reports, also the window of the rates
+        buckets: Upper bounds of the histogram buckets in seconds
+        lock: threading.Lock
+        values: {name: {labels: value}} of counters and gauges
+        histograms: {name: {labels: [bucket counts, sum, count]}}
+        rates: {name: {labels: per second}} of the counters over the last window
+        window: [start time, counter values] of the current window
+        next_report: Monotonic time of the next report
+    """
+
+    __slots__ = ['callback', 'interval', 'buckets', 'lock', 'values', 'histograms', 'rates', 'window',
+                 'next_report']
+
+    def __init__(self, callback=None, interval=10.0, buckets=LATENCY_BUCKETS):
+        self.callback = callback
+        self.interval = interval
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {name: {} for name, (kind, _, _) in METRICS.items() if kind != "histogram"}
+        self.histograms = {name: {} for name, (kind, _, _) in METRICS.items() if kind == "histogram"}
+        self.rates = {}
+        self.window = [time.monotonic(), {}]
+        self.next_report = self.window[0] + interval
+
+    def inc(self, name, value=1, labels=()):
+        """
+        Add to a counter or a gauge
+        """
+        with self.lock:
+            series = self.values[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.values[name][labels] = value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            series = self.histograms[name]
+            if labels not in series:
+                series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram = series[labels]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def maybe_report(self):
+        """
+        Close the rate window and call the callback when interval passed, cheap otherwise
+        """
+        now = time.monotonic()
+        if now < self.next_report:
+            return
+        with self.lock:
+            if now < self.next_report:
+                return
+            self.next_report = now + self.interval
+            start, previous = self.window
+            counters = {name: dict(series) for name, series in self.values.items()
+                        if METRICS[name][0] == "counter"}
+            self.rates = {name: {labels: (value - previous.get(name, {}).get(labels, 0)) / max(now - start, 1e-9)
+                                 for labels, value in series.items()}
+                          for name, series in counters.items()}
+            self.window = [now, counters]
+        if self.callback is not None:
+            try:
+                self.callback(self.snapshot())
+            except Exception as e:
+                print("\033[1;33;0mERROR : Metrics callback failed : {}\033[0m".format(e))
+
+    def snapshot(self):
+        """
+        :return: {"values": {name: {labels: value}},
+                  "histograms": {name: {labels: {"buckets": [[upper bound, cumulative count], ...], "sum", "count"}}},
+                  "rates": {name: {labels: per second over the last window}}}
+        """
+        with self.lock:
+            values = {name: dict(series) for name, series in self.values.items()}
+            histograms = {}
+            for name, series in self.histograms.items():
+                histograms[name] = {}
+                for labels, (counts, total, count) in series.items():
+                    cumulative = list(itertools.accumulate(counts))
+                    histograms[name][labels] = {"buckets": list(zip(self.buckets + (float("inf"),), cumulative)),
+                                                "sum": total, "count": count}
+            rates = {name: dict(series) for name, series in self.rates.items()}
+        return {"values": values, "histograms": histograms, "rates": rates}
+
+    def to_prometheus(self, prefix="ara_kafka_"):
+        """
+        :param prefix: Prefix of the metric names
+        :return: Prometheus text exposition format
+        """
+        def label_text(names, labels, extra=()):
+            pairs = list(zip(names, labels)) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                                  for key, value in pairs) + "}"
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, (kind, names, description) in sorted(METRICS.items()):
+            full_name = prefix + name
+            lines.append("# HELP {} {}".format(full_name, description))
+            lines.append("# TYPE {} {}".format(full_name, kind))
+            if kind != "histogram":
+                for labels, value in sorted(snapshot["values"][name].items()):
+                    lines.append("{}{} {}".format(full_name, label_text(names, labels), value))
+                continue
+            for labels, histogram in sorted(snapshot["histograms"][name].items()):
+                for bound, count in histogram["buckets"]:
+                    bound = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append("{}_bucket{} {}".format(full_name, label_text(names, labels, [("le", bound)]), count))
+                lines.append("{}_sum{} {}".format(full_name, label_text(names, labels), histogram["sum"]))
+                lines.append("{}_count{} {}".format(full_name, label_text(names, labels), histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def _offset_and_metadata(offset):
+    """
+    OffsetAndMetadata gained a leader_epoch field in kafka-python 2.1
+    :param offset: Offset of the next record to consume
+    :return: kafka.OffsetAndMetadata
+    """
+    if "leader_epoch" in kafka.OffsetAndMetadata._fields:
+        return kafka.OffsetAndMetadata(offset, "", -1)
+    return kafka.OffsetAndMetadata(offset, "")
+
+
+def _rebalance_listener(on_revoked, on_assigned):
+    """
+    kafka-python only accepts ConsumerRebalanceListener instances, the class is built here to keep kafka lazy
+    :param on_revoked: Callable(list of TopicPartition)
+    :param on_assigned: Callable(list of TopicPartition)
+    :return: ConsumerRebalanceListener
+    """
+    class _Listener(kafka.ConsumerRebalanceListener):
+        def on_partitions_revoked(self, revoked):
+            on_revoked(revoked)
+
+        def on_partitions_assigned(self, assigned):
+            on_assigned(assigned)
+
+    return _Listener()
 
 
 class KafkaProducerRunner(object):
@@ -29,39 +218,482 @@ class KafkaProducerRunner(object):
         producer: KafkaProducer object
         compression_type:The compression type for all data generated by
             the producer.
+        linger_ms: Milliseconds the producer waits for more messages before
+            sending a batch. Default: 0
+        batch_size: Max bytes of a batch per partition. Default: 16384
+        key_serializer: Callable(key) -> bytes. Default: _convert_message
+        value_serializer: Callable(value) -> bytes. Default: _convert_message
+        metrics: KafkaMetrics, send latency and acknowledged records/bytes
     """
 
-    __slots__ = ['bootstrap_servers', 'topic', 'producer', 'compression_type']
+    __slots__ = ['bootstrap_servers', 'topic', 'producer', 'compression_type',
+                 'linger_ms', 'batch_size', 'key_serializer', 'value_serializer', 'metrics']
 
-    def __init__(self, bootstrap_servers, topic, compression_type=None):
+    def __init__(self, bootstrap_servers, topic, compression_type=None, linger_ms=0, batch_size=16384,
+                 key_serializer=None, value_serializer=None, producer_factory=None, metrics=None):
+        """
+        :param producer_factory: Callable(bootstrap_servers=..., compression_type=..., linger_ms=..., batch_size=...)
+            returning a producer, e.g. a mocked client. Default: kafka.KafkaProducer
+        """
         self.bootstrap_servers = bootstrap_servers
         self.topic = topic
         self.compression_type = compression_type
-        self.producer = KafkaProducer(bootstrap_servers=self.bootstrap_servers, compression_type=self.compression_type)
+        self.linger_ms = linger_ms
+        self.batch_size = batch_size
+        self.key_serializer = self._convert_message if key_serializer is None else key_serializer
+        self.value_serializer = self._convert_message if value_serializer is None else value_serializer
+        self.metrics = KafkaMetrics() if metrics is None else metrics
+        factory = kafka.KafkaProducer if producer_factory is None else producer_factory
+        self.producer = factory(bootstrap_servers=self.bootstrap_servers, compression_type=self.compression_type,
+                                linger_ms=self.linger_ms, batch_size=self.batch_size)
 
     def send_message(self, key, value, timeout=10):
-        key = self._convert_message(key)
-        value = self._convert_message(value)
+        return self.send(key, value).get(timeout=timeout)
+
+    def send(self, key, value, callback=None, errback=None):
+        """
+        Send without waiting for the broker
+        :param key: Message key
+        :param value: Message value
+        :param callback: Called with the RecordMetadata once delivered
+        :param errback: Called with the exception if delivery failed
+        :return: FutureRecordMetadata
+        """
+        key, value = self.key_serializer(key), self.value_serializer(value)
+        started = time.monotonic()
         future = self.producer.send(self.topic, key=key, value=value)
-        return future.get(timeout=timeout)
+        self.metrics.inc("producer_pending")
+        size = (0 if key is None else len(key)) + (0 if value is None else len(value))
+        future.add_callback(lambda metadata: self._on_sent(started, size))
+        future.add_errback(lambda exception: self._on_error())
+        if callback is not None:
+            future.add_callback(callback)
+        if errback is not None:
+            future.add_errback(errback)
+        return future
+
+    def _on_sent(self, started, size):
+        self.metrics.observe("producer_send_seconds", time.monotonic() - started)
+        self.metrics.inc("producer_pending", -1)
+        self.metrics.inc("producer_records_total", 1, (self.topic,))
+        self.metrics.inc("producer_bytes_total", size, (self.topic,))
+        self.metrics.maybe_report()
+
+    def _on_error(self):
+        self.metrics.inc("producer_pending", -1)
+        self.metrics.inc("producer_errors_total", 1, (self.topic,))
+
+    def send_many(self, messages, callback=None, errback=None, flush=False, timeout=None):
+        """
+        Send many messages, the producer groups them into batches
+        :param messages: Iterable of (key, value)
+        :param callback: Called with the RecordMetadata of each delivered message
+        :param errback: Called with the exception of each failed message
+        :param flush: Block until all buffered messages are sent
+        :param timeout: Timeout in seconds of flush
+        :return: List of FutureRecordMetadata
+        """
+        futures = [self.send(key, value, callback=callback, errback=errback) for key, value in messages]
+        if flush:
+            self.flush(timeout=timeout)
+        return futures
+
+    def flush(self, timeout=None):
+        """
+        Send all buffered messages and wait for their acknowledgement
+        :param timeout: Timeout in seconds
+        """
+        self.producer.flush(timeout=timeout)
+
+    def close(self, timeout=None):
+        self.producer.close(timeout=timeout)
 
     @staticmethod
     def _convert_message(message):
-        if type(message) == "str":
-            message = message.encode("utf-8")
-        elif type(message) == "bytes":
-            pass
+        if message is None or isinstance(message, (bytes, bytearray, memoryview)):
+            return message
+        if isinstance(message, str):
+            return message.encode("utf-8")
+        return "{}".format(message).encode("utf-8")
+
+
+class _RecordBatch(object):
+    """Columnar buffer of consumer records
+
+    Attributes:
+        topics: List of topics
+        partitions: List of partitions
+        offsets: List of offsets
+        keys: List of keys
+        values: List of values
+        created: Monotonic time of the first record, None when empty
+        ranges: {TopicPartition: [first offset, last offset + 1]}
+    """
+
+    __slots__ = ['topics', 'partitions', 'offsets', 'keys', 'values', 'created', 'ranges']
+
+    def __init__(self):
+        self.topics = []
+        self.partitions = []
+        self.offsets = []
+        self.keys = []
+        self.values = []
+        self.created = None
+        self.ranges = {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def extend(self, tp, messages):
+        if not messages:
+            return
+        if self.created is None:
+            self.created = time.monotonic()
+        self.topics.extend([tp.topic] * len(messages))
+        self.partitions.extend([tp.partition] * len(messages))
+        for message in messages:
+            self.offsets.append(message.offset)
+            self.keys.append(message.key)
+            self.values.append(message.value)
+        first, end = messages[0].offset, messages[-1].offset + 1
+        if tp in self.ranges:
+            first, end = min(first, self.ranges[tp][0]), max(end, self.ranges[tp][1])
+        self.ranges[tp] = [first, end]
+
+    def elapsed_ms(self):
+        if self.created is None:
+            return 0
+        return (time.monotonic() - self.created) * 1000
+
+    def split(self, route):
+        """
+        Split the records by partition route, the order inside a partition is kept
+        :param route: Callable(topic, partition) -> key
+        :return: {key: _RecordBatch}
+        """
+        keys = {(tp.topic, tp.partition): route(tp.topic, tp.partition) for tp in self.ranges}
+        if len(set(keys.values())) <= 1:
+            return {key: self for key in set(keys.values())}
+        parts = {}
+        for key in keys.values():
+            parts[key] = _RecordBatch()
+            parts[key].created = self.created
+        for i, (topic, partition) in enumerate(zip(self.topics, self.partitions)):
+            part = parts[keys[(topic, partition)]]
+            part.topics.append(topic)
+            part.partitions.append(partition)
+            part.offsets.append(self.offsets[i])
+            part.keys.append(self.keys[i])
+            part.values.append(self.values[i])
+        for tp, offset_range in self.ranges.items():
+            parts[keys[(tp.topic, tp.partition)]].ranges[tp] = offset_range
+        return parts
+
+    def drop(self, partitions):
+        """
+        Drop the records of some partitions in place, e.g. revoked ones
+        :param partitions: List of TopicPartition
+        """
+        dropped = set((tp.topic, tp.partition) for tp in partitions)
+        kept = self.split(lambda topic, partition: (topic, partition) in dropped).get(False, _RecordBatch())
+        if kept is not self:
+            for name in self.__slots__:
+                setattr(self, name, getattr(kept, name))
+
+
+def _dump_batch(job_id, batch):
+    """
+    Serialize a batch with pickle protocol 5, bytes values are joined into one out-of-band buffer
+    :param job_id: Job id
+    :param batch: _RecordBatch
+    :return: List of bytes-like to send, the pickle stream first
+    """
+    values, lengths = batch.values, None
+    if all(value is None or isinstance(value, (bytes, bytearray, memoryview)) for value in values):
+        lengths = [-1 if value is None else len(value) for value in values]
+        values = pickle.PickleBuffer(b"".join(value for value in values if value is not None))
+    buffers = []
+    data = pickle.dumps((job_id, batch.topics, batch.partitions, batch.offsets, batch.keys, lengths, values),
+                        protocol=5, buffer_callback=buffers.append)
+    return [data] + [buffer.raw() for buffer in buffers]
+
+
+def _load_batch(data, connection, zero_copy=False):
+    """
+    :param data: Pickle stream from _dump_batch()
+    :param connection: Connection the out-of-band buffers are received from
+    :param zero_copy: Return values as memoryview slices of the received buffer instead of bytes
+    :return: job id, [topics, partitions, offsets, keys, values]
+    """
+    # loads() pulls exactly as many buffers as the stream references
+    job_id, topics, partitions, offsets, keys, lengths, values = pickle.loads(
+        data, buffers=iter(connection.recv_bytes, None))
+    if lengths is not None:
+        view, values, position = memoryview(values), [], 0
+        for length in lengths:
+            if length < 0:
+                values.append(None)
+                continue
+            value = view[position:position + length]
+            values.append(value if zero_copy else value.tobytes())
+            position += length
+    return job_id, [topics, partitions, offsets, keys, values]
+
+
+def _process_worker(runner, connection, results, zero_copy):
+    while True:
+        data = connection.recv_bytes()
+        if not data:
+            break
+        job_id, columns = _load_batch(data, connection, zero_copy)
+        error = None
+        started = time.monotonic()
+        try:
+            runner.process_batch(*columns)
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e)
+        results.send((job_id, error, started, time.monotonic() - started))
+    connection.close()
+    results.close()
+
+
+class _ProcessPool(object):
+    """Worker processes, the records of a partition always go to the same worker
+
+    When a worker dies before close() its pending and later jobs fail, so
+    that the runner never waits for them, and on_exit is called.
+
+    Attributes:
+        connections: Sending ends of the worker pipes
+        results: Receiving ends of the pipes of (job id, error or None, start time, duration) from the workers
+        locks: One lock per connection, a job is several messages
+        processes: List of multiprocessing.Process
+        alive: Whether each worker is still running
+        lock: threading.Lock of jobs and alive
+        jobs: {job id: [worker index, Future]}, the result is (start time, duration)
+        counter: Job id generator
+        collector: Thread completing the futures
+        closing: Whether close() was called, workers exit normally afterwards
+        on_exit: Callable(RuntimeError) called when a worker exits before close(), or None
+    """
+
+    __slots__ = ['connections', 'results', 'locks', 'processes', 'alive', 'lock', 'jobs', 'counter', 'collector',
+                 'closing', 'on_exit']
+
+    def __init__(self, runner, n_workers, zero_copy=False, on_exit=None):
+        context = multiprocessing.get_context()
+        self.connections, self.results, self.locks, self.processes = [], [], [], []
+        for _ in range(n_workers):
+            receiver, sender = context.Pipe(duplex=False)
+            result_receiver, result_sender = context.Pipe(duplex=False)
+            process = context.Process(target=_process_worker, args=(runner, receiver, result_sender, zero_copy))
+            process.daemon = True
+            process.start()
+            receiver.close()
+            result_sender.close()
+            self.connections.append(sender)
+            self.results.append(result_receiver)
+            self.locks.append(threading.Lock())
+            self.processes.append(process)
+        self.alive = [True] * n_workers
+        self.closing = False
+        self.on_exit = on_exit
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.counter = itertools.count()
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def route(self, topic, partition):
+        return zlib.crc32("{}-{}".format(topic, partition).encode("utf-8")) % len(self.connections)
+
+    def submit(self, index, batch):
+        future = Future()
+        job_id = next(self.counter)
+        with self.lock:
+            if not self.alive[index]:
+                future.set_exception(RuntimeError("Worker {} exited with code {}".format(
+                    index, self.processes[index].exitcode)))
+                return future
+            self.jobs[job_id] = [index, future]
+        try:
+            with self.locks[index]:
+                for data in _dump_batch(job_id, batch):
+                    self.connections[index].send_bytes(data)
+        except (BrokenPipeError, OSError) as e:
+            # The collector fails the other jobs once it sees the process exit
+            with self.lock:
+                if self.jobs.pop(job_id, None) is not None:
+                    future.set_exception(RuntimeError("Worker {} unreachable : {}".format(index, e)))
+        return future
+
+    def _collect(self):
+        receivers = {result: index for index, result in enumerate(self.results)}
+        sentinels = {process.sentinel: index for index, process in enumerate(self.processes)}
+        while receivers or sentinels:
+            for ready in multiprocessing.connection.wait(list(receivers) + list(sentinels)):
+                if ready in receivers:
+                    try:
+                        self._complete(ready.recv())
+                    except EOFError:
+                        del receivers[ready]
+                    continue
+                if ready not in sentinels:
+                    continue
+                index = sentinels.pop(ready)
+                # Results sent just before exiting are still in the pipe
+                result = self.results[index]
+                try:
+                    while result in receivers and result.poll():
+                        self._complete(result.recv())
+                except EOFError:
+                    pass
+                receivers.pop(result, None)
+                self._fail_worker(index)
+
+    def _complete(self, item):
+        job_id, error, started, duration = item
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+        if job is None:
+            return
+        if error is None:
+            job[1].set_result((started, duration))
         else:
-            message = "{}".format(message).encode("utf-8")
-        return message
+            job[1].set_exception(RuntimeError(error))
+
+    def _fail_worker(self, index):
+        with self.lock:
+            self.alive[index] = False
+            failed = [job_id for job_id, job in self.jobs.items() if job[0] == index]
+            futures = [self.jobs.pop(job_id)[1] for job_id in failed]
+            closing = self.closing
+        # The sentinel is ready once the process exited, join() reaps it so exitcode is set
+        self.processes[index].join()
+        exitcode = self.processes[index].exitcode
+        for future in futures:
+            future.set_exception(RuntimeError("Worker {} exited with code {}".format(index, exitcode)))
+        if closing:
+            return
+        print("\033[1;33;0mERROR : Worker {} exited with code {}, {} jobs failed\033[0m".format(
+            index, exitcode, len(futures)))
+        if self.on_exit is not None:
+            self.on_exit(RuntimeError("Worker {} exited with code {}".format(index, exitcode)))
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+        for connection, lock in zip(self.connections, self.locks):
+            with lock:
+                try:
+                    connection.send_bytes(b"")
+                except (BrokenPipeError, OSError):
+                    pass
+                connection.close()
+        for process in self.processes:
+            process.join()
+        self.collector.join()
+        for result in self.results:
+            result.close()
+
+
+class _OffsetTracker(object):
+    """Offsets handed to processing, per partition
+
+    The committable offset of a partition is the first offset of its oldest
+    unfinished batch, or the end of the dispatched records once all of them
+    finished. Failed batches are never completed, so their records are
+    consumed again after a restart or a rebalance (at-least-once).
+
+    Attributes:
+        lock: threading.Lock
+        counter: Batch token generator
+        partitions: {TopicPartition: [generation, end offset, {token: first offset}]},
+            the generation changes on rebalance so that late completions are ignored
+        committed: {TopicPartition: last committed offset}
+    """
+
+    __slots__ = ['lock', 'counter', 'partitions', 'committed']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.partitions = {}
+        self.committed = {}
+
+    def add(self, ranges):
+        """
+        :param ranges: {TopicPartition: [first offset, end offset]} of a batch
+        :return: Token for complete()
+        """
+        with self.lock:
+            token = next(self.counter)
+            generations = {}
+            for tp, (first, end) in ranges.items():
+                state = self.partitions.setdefault(tp, [0, end, {}])
+                state[1] = max(state[1], end)
+                state[2][token] = first
+                generations[tp] = state[0]
+        return token, generations
+
+    def complete(self, token):
+        token, generations = token
+        with self.lock:
+            for tp, generation in generations.items():
+                state = self.partitions.get(tp)
+                if state is not None and state[0] == generation:
+                    state[2].pop(token, None)
+
+    def reset(self, partitions):
+        with self.lock:
+            for tp in partitions:
+                state = self.partitions.pop(tp, None)
+                if state is not None:
+                    self.partitions[tp] = [state[0] + 1, 0, {}]
+                self.committed.pop(tp, None)
+
+    def committable(self, partitions=None):
+        """
+        :param partitions: Restrict to these partitions, default all
+        :return: {TopicPartition: offset} that moved since the last commit
+        """
+        offsets = {}
+        with self.lock:
+            for tp, (_, end, outstanding) in self.partitions.items():
+                if partitions is not None and tp not in partitions:
+                    continue
+                offset = min(outstanding.values()) if outstanding else end
+                if offset > self.committed.get(tp, 0):
+                    offsets[tp] = offset
+        return offsets
+
+    def mark_committed(self, offsets):
+        with self.lock:
+            self.committed.update(offsets)
 
 
 class KafkaConsumerRunner(object):
     """KafkaConsumerRunner
 
     Advanced class from KafkaProducer.
-        1.Implement abstract function process_records()
-        2.call run()
+        1.Implement abstract function process_records(), or process_batch() to
+            handle the records of a batch at once
+        2.call run(), stop() to quit
+
+    In "inline" mode each of the max_workers threads owns a consumer and
+    processes its batches itself, offsets are auto-committed.
+    In "pipelined" mode n_consumers threads poll and hand the batches to the
+    executor (process_batch() must be thread safe). When max_in_flight batches
+    are pending the partitions are paused until one finishes. Auto-commit is
+    off, offsets are committed every commit_interval_ms up to the first
+    unfinished batch of each partition.
+    In "process" mode batches are pipelined the same way, but processed by
+    max_workers worker processes. The records of a partition always go to
+    the same worker, so they are processed in order. The runner is pickled
+    to the workers when the start method is not fork. When a worker dies the
+    runner stops, and run() raises RuntimeError once the batches held by the
+    other workers finished.
 
     Attributes:
         bootstrap_servers: 'host[:port]' string (or list of 'host[:port]'
@@ -78,24 +710,101 @@ class KafkaConsumerRunner(object):
         poll_max_records: The maximum number of records returned
                 in a single call to :meth:`~kafka.KafkaConsumer.poll`.
                 Default: Inherit value from max_poll_records.
+        batch_max_records: A batch is processed once it holds this many
+                records. Default: poll_max_records
+        batch_timeout_ms: A batch is processed once its first record waited
+                this long, even if it is not full. Default: 0, each poll
+                result is processed as soon as it is returned
+        consumer_factory: Callable(group_id=..., bootstrap_servers=...)
+                returning a consumer, e.g. an in-process fake for tests.
+                Default: kafka.KafkaConsumer
+        mode: "inline", "pipelined" or "process"
+        n_consumers: Num of polling threads in pipelined and process mode
+        max_in_flight: Max num of batches queued or processing in pipelined
+                and process mode. Default: 2 * max_workers
+        commit_interval_ms: Milliseconds between offset commits in pipelined
+                and process mode
+        zero_copy: In process mode, give process_batch() the bytes values as
+                memoryview slices of the received buffer instead of copies
+        metrics: KafkaMetrics, per partition records/bytes and lag, queue
+                depth, poll-to-process and processing latency
+        verbose: Print a line per processed batch
+        in_flight: threading.Semaphore bounding the pending batches
+        pool: _ProcessPool while running in process mode
+        executor: ThreadPoolExecutor of inline and pipelined mode, created by run()
+        error: Exception stopping the runner, raised by run()
     """
 
     __slots__ = ['bootstrap_servers', 'max_workers', 'group_id', 'topics',
-                 'executor', 'poll_timeout_ms', 'poll_max_records']
+                 'executor', 'poll_timeout_ms', 'poll_max_records',
+                 'batch_max_records', 'batch_timeout_ms', 'consumer_factory', 'running',
+                 'mode', 'n_consumers', 'max_in_flight', 'commit_interval_ms', 'in_flight',
+                 'zero_copy', 'pool', 'metrics', 'verbose', 'error']
 
     def __init__(self, bootstrap_servers, group_id, topics, max_workers,
-                 poll_timeout_ms=200, poll_max_records=200):
+                 poll_timeout_ms=200, poll_max_records=200,
+                 batch_max_records=None, batch_timeout_ms=0, consumer_factory=None,
+                 mode="inline", n_consumers=1, max_in_flight=None, commit_interval_ms=1000, zero_copy=False,
+                 metrics=None, verbose=False):
+        if mode not in CONSUMER_MODES:
+            raise ValueError("Mode Error! Must be one of {}".format(CONSUMER_MODES))
+        if mode == "process" and sys.version_info < (3, 8):
+            # Batches are sent with pickle protocol 5 out-of-band buffers
+            raise RuntimeError("Python Version Error! Process mode needs Python>=3.8")
         self.bootstrap_servers = bootstrap_servers
         self.group_id = group_id
         self.topics = topics
         self.poll_timeout_ms = poll_timeout_ms
         self.poll_max_records = poll_max_records
+        self.batch_max_records = poll_max_records if batch_max_records is None else batch_max_records
+        self.batch_timeout_ms = batch_timeout_ms
+        self.consumer_factory = consumer_factory
         self.max_workers = max_workers
-        self.executor = self._create_executor()
+        self.mode = mode
+        self.n_consumers = n_consumers
+        self.max_in_flight = 2 * max_workers if max_in_flight is None else max_in_flight
+        self.commit_interval_ms = commit_interval_ms
+        self.in_flight = threading.Semaphore(self.max_in_flight)
+        self.zero_copy = zero_copy
+        self.pool = None
+        self.metrics = KafkaMetrics() if metrics is None else metrics
+        self.verbose = verbose
+        self.running = False
+        self.executor = None
+        self.error = None
+
+    def __getstate__(self):
+        # Workers only call process_batch(), what drives the consumers stays in the parent
+        state = dict(getattr(self, "__dict__", {}))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        for name in ("executor", "in_flight", "pool", "consumer_factory", "metrics", "error", "__dict__",
+                     "__weakref__"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.executor = None
+        self.in_flight = threading.Semaphore(self.max_in_flight)
+        self.pool = None
+        self.consumer_factory = None
+        self.metrics = None
+        self.error = None
 
-    def _create_consumer(self):
-        consumer = KafkaConsumer(group_id=self.group_id, bootstrap_servers=self.bootstrap_servers)
-        consumer.subscribe(topics=self.topics)
+    def _new_consumer(self, **configs):
+        factory = kafka.KafkaConsumer if self.consumer_factory is None else self.consumer_factory
+        return factory(group_id=self.group_id, bootstrap_servers=self.bootstrap_servers, **configs)
+
+    def _create_consumer(self, listener=None, **configs):
+        consumer = self._new_consumer(**configs)
+        if listener is None:
+            consumer.subscribe(topics=self.topics)
+        else:
+            consumer.subscribe(topics=self.topics, listener=listener)
         return consumer
 
     def _create_executor(self):
@@ -103,27 +812,229 @@ class KafkaConsumerRunner(object):
         return executor
     
     def _get_partition_set(self):
-        consumer = KafkaConsumer(group_id=self.group_id, bootstrap_servers=self.bootstrap_servers)
+        consumer = self._new_consumer()
         partition_set = consumer.partitions_for_topic(self.topics)
         return partition_set
 
+    def _poll_batch(self, consumer, batch):
+        """
+        Poll until the batch is full or batch_timeout_ms passed since its first record
+        :param consumer: Consumer
+        :param batch: _RecordBatch to fill
+        :return: True if the batch is ready to be processed
+        """
+        remaining_ms = self.batch_timeout_ms - batch.elapsed_ms() if len(batch) else self.poll_timeout_ms
+        max_records = min(self.poll_max_records, self.batch_max_records - len(batch))
+        msg_pack = consumer.poll(timeout_ms=max(0, int(min(self.poll_timeout_ms, remaining_ms))),
+                                 max_records=max_records)
+        self._observe_poll(consumer, msg_pack)
+        for tp, messages in msg_pack.items():
+            batch.extend(tp, messages)
+        return len(batch) >= self.batch_max_records or \
+            (len(batch) > 0 and batch.elapsed_ms() >= self.batch_timeout_ms)
+
+    def _observe_poll(self, consumer, msg_pack):
+        """
+        Records, bytes and lag per partition of a poll result
+        """
+        for tp, messages in msg_pack.items():
+            labels = (tp.topic, tp.partition)
+            self.metrics.inc("consumer_records_total", len(messages), labels)
+            self.metrics.inc("consumer_bytes_total", sum(max(0, message.serialized_key_size) +
+                                                         max(0, message.serialized_value_size)
+                                                         for message in messages), labels)
+            highwater = consumer.highwater(tp) if hasattr(consumer, "highwater") else None
+            if highwater is not None and messages:
+                self.metrics.set("consumer_lag", max(0, highwater - messages[-1].offset - 1), labels)
+        self.metrics.maybe_report()
+
+    def _process_batch(self, batch):
+        """
+        :return: Start time, duration of process_batch()
+        """
+        started = time.monotonic()
+        self.process_batch(batch.topics, batch.partitions, batch.offsets, batch.keys, batch.values)
+        return started, time.monotonic() - started
+
+    def _observe_batch(self, batch, started, duration):
+        self.metrics.observe("consumer_poll_to_process_seconds", max(0.0, started - batch.created))
+        self.metrics.observe("consumer_process_seconds", duration)
+
     def _task(self, task_id):
         consumer = self._create_consumer()
-        # for message in consumer:
-        #     self.executor.submit(self.process_records, msg.key, msg.value)
-        while True:
-            msg_pack = consumer.poll(timeout_ms=self.poll_timeout_ms, max_records=self.poll_max_records)
-            for tp, messages in msg_pack.items():
-                print("task-{} process {} message.".format(task_id, len(messages)))
-                for message in messages:
-                    self.process_records(tp.topic, tp.partition, message.offset, message.key, message.value)
+        batch = _RecordBatch()
+        try:
+            while self.running:
+                if self._poll_batch(consumer, batch):
+                    if self.verbose:
+                        print("task-{} process {} message.".format(task_id, len(batch)))
+                    self._observe_batch(batch, *self._process_batch(batch))
+                    batch = _RecordBatch()
+            if len(batch):
+                self._observe_batch(batch, *self._process_batch(batch))
+        finally:
+            consumer.close()
+        return "task-{} stopped.".format(task_id)
+
+    def _commit(self, consumer, tracker, partitions=None):
+        # Never commit for partitions owned by another consumer since a rebalance
+        assignment = set(consumer.assignment())
+        offsets = tracker.committable(assignment if partitions is None else assignment & set(partitions))
+        if not offsets:
+            return
+        try:
+            consumer.commit(offsets={tp: _offset_and_metadata(offset) for tp, offset in offsets.items()})
+            tracker.mark_committed(offsets)
+        except Exception as e:
+            print("\033[1;33;0mERROR : Commit {} failed : {}\033[0m".format(offsets, e))
+
+    def _submit_batch(self, task_id, batch, tracker, futures):
+        """
+        Hand a batch to the executor, a slot of in_flight must be held
+        """
+        if self.verbose:
+            print("task-{} process {} message.".format(task_id, len(batch)))
+        self.metrics.inc("consumer_queue_depth")
+        if self.mode == "process":
+            parts = batch.split(self.pool.route)
+        else:
+            parts = {None: batch}
+        # The slot is released once every part finished
+        remaining = [len(parts), threading.Lock()]
+        for index, part in parts.items():
+            token = tracker.add(part.ranges)
+            if self.mode == "process":
+                future = self.pool.submit(index, part)
+            else:
+                future = self.executor.submit(self._process_batch, part)
+            futures.add(future)
+            future.add_done_callback(
+                lambda f, part=part, token=token: self._batch_done(f, part, tracker, token, futures, remaining))
+
+    def _batch_done(self, future, batch, tracker, token, futures, remaining):
+        with remaining[1]:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                self.in_flight.release()
+                self.metrics.inc("consumer_queue_depth", -1)
+        futures.discard(future)
+        if future.exception() is None:
+            tracker.complete(token)
+            self._observe_batch(batch, *future.result())
+        else:
+            self.metrics.inc("consumer_batch_errors_total")
+            print("\033[1;33;0mERROR : Batch {} failed, it stays uncommitted : {}\033[0m".format(
+                {"{}-{}".format(tp.topic, tp.partition): r for tp, r in batch.ranges.items()}, future.exception()))
+
+    def _pipeline_task(self, task_id):
+        tracker = _OffsetTracker()
+        futures = set()
+        # The listener is called from inside poll() of this thread
+        state = {"consumer": None, "paused": False, "batch": _RecordBatch(), "ready": None}
+
+        def on_revoked(revoked):
+            self._commit(state["consumer"], tracker, revoked)
+            tracker.reset(revoked)
+            # Records of revoked partitions belong to the next owner
+            for held in (state["batch"], state["ready"]):
+                if held is not None:
+                    held.drop(revoked)
+
+        def on_assigned(assigned):
+            tracker.reset(assigned)
+            if state["paused"] and assigned:
+                state["consumer"].pause(*assigned)
+
+        consumer = self._create_consumer(listener=_rebalance_listener(on_revoked, on_assigned),
+                                         enable_auto_commit=False)
+        state["consumer"] = consumer
+        last_commit = time.monotonic()
+        try:
+            while self.running:
+                if state["ready"] is None and self._poll_batch(consumer, state["batch"]):
+                    state["ready"], state["batch"] = state["batch"], _RecordBatch()
+                if state["ready"] is not None and not len(state["ready"]):
+                    # Everything it held was revoked
+                    state["ready"] = None
+                    if state["paused"]:
+                        consumer.resume(*consumer.paused())
+                        state["paused"] = False
+                if state["ready"] is not None:
+                    if self.in_flight.acquire(timeout=self.poll_timeout_ms / 1000 if state["paused"] else 0):
+                        self._submit_batch(task_id, state["ready"], tracker, futures)
+                        state["ready"] = None
+                        if state["paused"]:
+                            consumer.resume(*consumer.paused())
+                            state["paused"] = False
+                    elif not state["paused"]:
+                        consumer.pause(*consumer.assignment())
+                        state["paused"] = True
+                    else:
+                        # Paused partitions return nothing, polling keeps the group membership alive
+                        msg_pack = consumer.poll(timeout_ms=0)
+                        self._observe_poll(consumer, msg_pack)
+                        for tp, messages in msg_pack.items():
+                            state["batch"].extend(tp, messages)
+                if time.monotonic() - last_commit >= self.commit_interval_ms / 1000:
+                    self._commit(consumer, tracker)
+                    last_commit = time.monotonic()
+            for pending in (state["ready"], state["batch"]):
+                if pending is not None and len(pending):
+                    self.in_flight.acquire()
+                    self._submit_batch(task_id, pending, tracker, futures)
+            wait(list(futures))
+            self._commit(consumer, tracker)
+        finally:
+            consumer.close()
+        return "task-{} stopped.".format(task_id)
+
+    def _worker_exited(self, error):
+        self.error = error
+        self.stop()
 
     def run(self):
-        all_task = [self.executor.submit(self._task, task_id) for task_id in range(self.max_workers)]
+        self.running = True
+        self.error = None
+        pollers = None
+        if self.mode == "process":
+            self.pool = _ProcessPool(self, self.max_workers, zero_copy=self.zero_copy, on_exit=self._worker_exited)
+        elif self.executor is None:
+            self.executor = self._create_executor()
+        if self.mode in ("pipelined", "process"):
+            pollers = ThreadPoolExecutor(max_workers=self.n_consumers)
+            all_task = [pollers.submit(self._pipeline_task, task_id) for task_id in range(self.n_consumers)]
+        else:
+            all_task = [self.executor.submit(self._task, task_id) for task_id in range(self.max_workers)]
         # all_task = [self.executor.submit(self._task, task_id) for task_id in self._get_partition_set()]
         for future in as_completed(all_task):
             result = future.result()
             print(result)
+        if pollers is not None:
+            pollers.shutdown()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        """
+        Ask the tasks to process what they hold and quit, run() returns afterwards
+        """
+        self.running = False
+
+    def process_batch(self, topics, partitions, offsets, keys, values):
+        """
+        Process a batch of records, columns are aligned lists.
+        Override for vectorized processing, the default calls process_records() per record.
+        :param topics: List of topics
+        :param partitions: List of partitions
+        :param offsets: List of offsets
+        :param keys: List of keys
+        :param values: List of values
+        """
+        for topic, partition, offset, key, value in zip(topics, partitions, offsets, keys, values):
+            self.process_records(topic, partition, offset, key, value)
 
     @abstractmethod
     def process_records(self, topic, partition, offset, key, value):
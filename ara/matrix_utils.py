@@ -13,67 +13,402 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import sys
+import json
+import warnings
+
 import numpy as np
-from sklearn import preprocessing
-from sklearn.metrics.pairwise import euclidean_distances, cosine_similarity
 
+from concurrent.futures import ThreadPoolExecutor
+
+from ara.import_utils import LazyModule
+
+preprocessing = LazyModule("sklearn.preprocessing")
+pairwise = LazyModule("sklearn.metrics.pairwise")
+sparse = LazyModule("scipy.sparse")
+pd = LazyModule("pandas")
+file_utils = LazyModule("ara.file_utils")
+
+DEFAULT_BLOCK_BYTES = 64 * 1024 * 1024
+DEFAULT_TOPK_BLOCK_SIZE = 4096
 
-def matrix_normalization(array_input, axis=0):
+
+def _is_sparse(array_input):
     """
-    MinMax the input matrix in terms of dimensions.[0~1](归一化)
+    Whether the input is a scipy.sparse matrix, without importing scipy for dense inputs
+    """
+    if isinstance(array_input, np.ndarray) or "scipy.sparse" not in sys.modules:
+        return False
+    return sys.modules["scipy.sparse"].issparse(array_input)
+
+
+def _check_matrix(array_input, allow_sparse=False):
+    if allow_sparse and _is_sparse(array_input):
+        return
+    if not isinstance(array_input, np.ndarray):
+        if allow_sparse:
+            raise TypeError("Data matrix format error！Not numpy.array or scipy.sparse matrix!")
+        raise TypeError("Data matrix format error！Not numpy.array!")
+
+
+def _sparse_float(array_input):
+    """
+    Sparse matrix in CSR/CSC format with a float dtype
+    """
+    if array_input.format not in ("csr", "csc"):
+        array_input = array_input.tocsr()
+    return array_input.astype(_float_dtype(array_input), copy=False)
+
+
+def _sparse_scale(array_input, scale, axis=0):
+    """
+    Multiply each column(axis=0) or row(axis=1) of a sparse matrix, without densifying it
+    :param array_input: scipy.sparse matrix
+    :param scale: Scale vector
+    :param axis: Scaled dimensions
+    :return: scipy.sparse matrix in the input format
+    """
+    diagonal = sparse.diags(np.asarray(scale, dtype=array_input.dtype))
+    if axis == 0:
+        return (array_input @ diagonal).asformat(array_input.format)
+    return (diagonal @ array_input).asformat(array_input.format)
+
+
+def _as_matrix(array_input, dtype=None):
+    """
+    2-D numpy.array(), scipy.sparse matrices are kept sparse in CSR/CSC format so rows can be sliced
+    """
+    if _is_sparse(array_input):
+        if array_input.format not in ("csr", "csc"):
+            array_input = array_input.tocsr()
+        return array_input if dtype is None else array_input.astype(dtype, copy=False)
+    return np.atleast_2d(np.asarray(array_input, dtype=dtype))
+
+
+def _to_dense(array_input):
+    if _is_sparse(array_input):
+        return array_input.toarray()
+    return np.asarray(array_input)
+
+
+def _row_dot(matrix_a, matrix_b):
+    """
+    :return: Dot product of each pair of aligned rows(float64)
+    """
+    if _is_sparse(matrix_a) or _is_sparse(matrix_b):
+        # Integer values would overflow when multiplied in their own dtype
+        if _is_sparse(matrix_b):
+            product = matrix_b.astype(np.float64).multiply(matrix_a)
+        else:
+            product = matrix_a.astype(np.float64).multiply(matrix_b)
+        return np.asarray(product.sum(axis=1), dtype=np.float64).ravel()
+    return np.einsum("ij,ij->i", matrix_a, matrix_b, dtype=np.float64)
+
+
+def _sparse_moments(array_input, axis=0):
+    """
+    :return: [mean, std] of a sparse matrix along axis, in float64
+    """
+    # Compressed along the reduced axis, so each column(axis=0) or row(axis=1) is one slice of data
+    matrix = (array_input.tocsc() if axis == 0 else array_input.tocsr()).astype(np.float64)
+    matrix.sum_duplicates()
+    n, m = array_input.shape[axis], array_input.shape[1 - axis]
+    counts = np.diff(matrix.indptr)
+    index = np.repeat(np.arange(m), counts)
+    mean = np.bincount(index, weights=matrix.data, minlength=m) / n
+    # Squared deviations of the stored values, plus those of the implicit zeros
+    m2 = np.bincount(index, weights=np.square(matrix.data - mean[index]), minlength=m) + (n - counts) * np.square(mean)
+    return mean, np.sqrt(m2 / n)
+
+
+def _float_dtype(array_input):
+    """
+    Floating inputs keep their dtype, others are computed in float64
+    """
+    if np.issubdtype(array_input.dtype, np.floating):
+        return array_input.dtype
+    return np.dtype(np.float64)
+
+
+def _prepare_out(array_input, out=None):
+    """
+    Check or allocate the output matrix
     :param array_input: Input numpy.array()
+    :param out: Output numpy.array()(may be array_input or a numpy.memmap), None allocates one
+    :return: Output numpy.array()
+    """
+    if out is None:
+        return np.empty(array_input.shape, dtype=_float_dtype(array_input))
+    if not isinstance(out, np.ndarray) or out.shape != array_input.shape:
+        raise ValueError("Output matrix shape error!")
+    if not np.issubdtype(out.dtype, np.floating):
+        raise TypeError("Output matrix dtype error！Not float!")
+    return out
+
+
+def _row_blocks(array_input, block_size=None):
+    """
+    Split the rows of the matrix into blocks
+    :param array_input: Input numpy.array()
+    :param block_size: Rows per block, None uses about DEFAULT_BLOCK_BYTES per block
+    :return: Generator of row slices
+    """
+    n_rows = array_input.shape[0]
+    if block_size is None:
+        row_bytes = array_input.dtype.itemsize * int(np.prod(array_input.shape[1:]))
+        block_size = max(1, DEFAULT_BLOCK_BYTES // max(1, row_bytes))
+    for start in range(0, n_rows, block_size):
+        yield slice(start, min(start + block_size, n_rows))
+
+
+def _merge_moments(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """
+    Merge the (count, mean, sum of squared deviations) of two sets(Chan et al.)
+    :return: [count, mean, sum of squared deviations]
+    """
+    n = n_a + n_b
+    if n_a == 0:
+        return n_b, mean_b, m2_b
+    if n_b == 0:
+        return n_a, mean_a, m2_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + delta ** 2 * (n_a * n_b / n)
+    return n, mean, m2
+
+
+def _block_moments(block):
+    """
+    :param block: Block of rows
+    :return: [count, column mean, column sum of squared deviations] in float64
+    """
+    mean = block.mean(axis=0, dtype=np.float64)
+    m2 = np.square(block - mean).sum(axis=0)
+    return block.shape[0], mean, m2
+
+
+def matrix_normalization(array_input, axis=0, out=None, block_size=None):
+    """
+    MinMax the input matrix in terms of dimensions.[0~1](归一化)
+    Float inputs keep their dtype. The matrix is processed in row blocks,
+    so numpy.memmap inputs larger than memory work with a numpy.memmap "out".
+    scipy.sparse inputs stay sparse, their all-zero dimensions stay zero.
+    :param array_input: Input numpy.array() or scipy.sparse matrix
     :param axis: MinMax dimensions
+    :param out: Output numpy.array(), pass array_input to normalize in place
+    :param block_size: Rows per block
     :return: The MinMax matrix
     """
-    if type(array_input) != np.ndarray:
-        raise TypeError("Data matrix format error！Not numpy.array!")
+    _check_matrix(array_input, allow_sparse=True)
+    if axis not in (0, 1):
+        raise ValueError("Axis Value Error!")
+    if _is_sparse(array_input):
+        if out is not None:
+            raise ValueError("Output matrix is not supported for sparse input!")
+        array_input = _sparse_float(array_input)
+        max_value = array_input.max(axis=axis).toarray().ravel()
+        max_value[max_value == 0] = 1
+        return _sparse_scale(array_input, 1 / max_value, axis=axis)
+    out = _prepare_out(array_input, out)
+    matrix, matrix_out = array_input, out
+    if array_input.ndim == 1:
+        matrix, matrix_out = array_input.reshape(-1, 1), out.reshape(-1, 1)
     if axis == 0:
-        array_normalization = array_input / array_input.max(axis=axis)
-        return array_normalization
-    elif axis == 1:
-        array_normalization = array_input.T / array_input.max(axis=axis)
-        return array_normalization.T
+        max_value = None
+        for rows in _row_blocks(matrix, block_size):
+            block_max = matrix[rows].max(axis=0)
+            max_value = block_max if max_value is None else np.maximum(max_value, block_max)
+        for rows in _row_blocks(matrix, block_size):
+            np.divide(matrix[rows], max_value, out=matrix_out[rows])
     else:
-        raise ValueError("Axis Value Error!")
+        for rows in _row_blocks(matrix, block_size):
+            block = matrix[rows]
+            np.divide(block, block.max(axis=1, keepdims=True), out=matrix_out[rows])
+    return out
 
 
-def matrix_standardization(array_input, axis=0):
+def matrix_standardization(array_input, axis=0, out=None, block_size=None, with_mean=True):
     """
     Standardized input matrix.(标准化)
-    :param array_input: Input numpy.array()
+    Float inputs keep their dtype, statistics are accumulated in float64. The matrix is
+    processed in row blocks, so numpy.memmap inputs larger than memory work with a numpy.memmap "out".
+    scipy.sparse inputs stay sparse and require with_mean=False, since centering densifies them.
+    :param array_input: Input numpy.array() or scipy.sparse matrix
     :param axis: standardized dimensions
+    :param out: Output numpy.array(), pass array_input to standardize in place
+    :param block_size: Rows per block
+    :param with_mean: Whether to subtract the mean, otherwise only divide by the std
     :return: [The Standardized matrix, mean of matrix, std of matrix]
     """
-    if type(array_input) != np.ndarray:
-        raise TypeError("Data matrix format error！Not numpy.array!")
-    if axis == 0:
-        mean = array_input.mean(axis=axis)
-        std = array_input.std(axis=axis)
-        # Prevent the standard deviation from being zero
-        std = np.where(std == 0, 1, std)
-        array_standardization = (array_input - mean) / std
-        return array_standardization, mean, std
-    elif axis == 1:
-        mean = array_input.mean(axis=axis)
-        std = array_input.std(axis=axis)
+    _check_matrix(array_input, allow_sparse=True)
+    if axis not in (0, 1):
+        raise ValueError("Axis Value Error!")
+    if _is_sparse(array_input):
+        if with_mean:
+            raise ValueError("Centering a sparse matrix densifies it, use with_mean=False!")
+        if out is not None:
+            raise ValueError("Output matrix is not supported for sparse input!")
+        array_input = _sparse_float(array_input)
+        mean, std = _sparse_moments(array_input, axis=axis)
         # Prevent the standard deviation from being zero
         std = np.where(std == 0, 1, std)
-        array_standardization = (array_input.T - mean) / std
-        return array_standardization.T, mean, std
+        return _sparse_scale(array_input, 1 / std, axis=axis), mean.astype(array_input.dtype), \
+            std.astype(array_input.dtype)
+    out = _prepare_out(array_input, out)
+    matrix, matrix_out = array_input, out
+    if array_input.ndim == 1:
+        matrix, matrix_out = array_input.reshape(-1, 1), out.reshape(-1, 1)
+    if axis == 0:
+        standardizer = StreamingStandardizer().partial_fit(matrix, block_size=block_size)
+        standardizer.transform(matrix, out=matrix_out, block_size=block_size, with_mean=with_mean)
+        mean, std = standardizer.mean.astype(out.dtype), standardizer.std.astype(out.dtype)
+        if array_input.ndim == 1:
+            mean, std = mean[0], std[0]
     else:
-        raise ValueError("Axis Value Error!")
+        mean_list, std_list = [], []
+        for rows in _row_blocks(matrix, block_size):
+            block = matrix[rows]
+            block_mean = block.mean(axis=1, dtype=np.float64)
+            block_std = block.std(axis=1, dtype=np.float64)
+            # Prevent the standard deviation from being zero
+            block_std = np.where(block_std == 0, 1, block_std).astype(out.dtype)
+            block_mean = block_mean.astype(out.dtype)
+            if with_mean:
+                np.subtract(block, block_mean[:, None], out=matrix_out[rows])
+                np.divide(matrix_out[rows], block_std[:, None], out=matrix_out[rows])
+            else:
+                np.divide(block, block_std[:, None], out=matrix_out[rows])
+            mean_list.append(block_mean)
+            std_list.append(block_std)
+        mean, std = np.concatenate(mean_list), np.concatenate(std_list)
+    return out, mean, std
+
+
+class StreamingStandardizer(object):
+    """StreamingStandardizer
+
+    Column standardization statistics accumulated chunk by chunk.
+        1.partial_fit() on each chunk(or merge() the standardizers of other workers)
+        2.transform() with the stored mean and std
+
+    The running moments are merged with the parallel variance formula(Chan et al.)
+    in float64, so the result matches matrix_standardization(axis=0).
+
+    Attributes:
+        n_samples: Number of rows seen
+        mean: Column mean
+        std: Column std(zero std is replaced by one)
+    """
+
+    def __init__(self):
+        self.n_samples = 0
+        self._mean = None
+        self._m2 = None
+
+    def partial_fit(self, array_input, block_size=None):
+        """
+        Update the statistics with a chunk of rows
+        :param array_input: Input numpy.array() or scipy.sparse matrix, a 1-D array is one row
+        :param block_size: Rows per block
+        :return: self
+        """
+        _check_matrix(array_input, allow_sparse=True)
+        if _is_sparse(array_input):
+            mean, std = _sparse_moments(array_input, axis=0)
+            self._update(array_input.shape[0], mean, np.square(std) * array_input.shape[0])
+            return self
+        if array_input.ndim == 1:
+            array_input = array_input.reshape(1, -1)
+        for rows in _row_blocks(array_input, block_size):
+            self._update(*_block_moments(array_input[rows]))
+        return self
+
+    def _update(self, n, mean, m2):
+        if self._mean is None:
+            self.n_samples, self._mean, self._m2 = n, mean, m2
+            return
+        if mean.shape != self._mean.shape:
+            raise ValueError("Data matrix columns error!")
+        self.n_samples, self._mean, self._m2 = _merge_moments(self.n_samples, self._mean, self._m2, n, mean, m2)
+
+    def merge(self, other):
+        """
+        Merge the statistics of another StreamingStandardizer(e.g. from another process)
+        :param other: StreamingStandardizer object
+        :return: self
+        """
+        if other.n_samples > 0:
+            self._update(other.n_samples, other._mean, other._m2)
+        return self
+
+    @property
+    def mean(self):
+        if self._mean is None:
+            raise ValueError("StreamingStandardizer is not fitted!")
+        return self._mean
+
+    @property
+    def std(self):
+        if self._m2 is None:
+            raise ValueError("StreamingStandardizer is not fitted!")
+        std = np.sqrt(self._m2 / self.n_samples)
+        # Prevent the standard deviation from being zero
+        return np.where(std == 0, 1, std)
+
+    def transform(self, array_input, out=None, block_size=None, with_mean=True):
+        """
+        Standardize with the stored statistics
+        :param array_input: Input numpy.array() or scipy.sparse matrix(requires with_mean=False)
+        :param out: Output numpy.array(), pass array_input to standardize in place
+        :param block_size: Rows per block
+        :param with_mean: Whether to subtract the mean, otherwise only divide by the std
+        :return: The Standardized matrix
+        """
+        _check_matrix(array_input, allow_sparse=True)
+        if _is_sparse(array_input):
+            if with_mean:
+                raise ValueError("Centering a sparse matrix densifies it, use with_mean=False!")
+            return _sparse_scale(_sparse_float(array_input), 1 / self.std, axis=0)
+        out = _prepare_out(array_input, out)
+        mean, std = self.mean.astype(out.dtype), self.std.astype(out.dtype)
+        if array_input.ndim == 1:
+            if with_mean:
+                return np.divide(np.subtract(array_input, mean, out=out), std, out=out)
+            return np.divide(array_input, std, out=out)
+        for rows in _row_blocks(array_input, block_size):
+            if with_mean:
+                np.subtract(array_input[rows], mean, out=out[rows])
+                np.divide(out[rows], std, out=out[rows])
+            else:
+                np.divide(array_input[rows], std, out=out[rows])
+        return out
+
+    def get_state(self):
+        """
+        :return: Dict of the statistics, restore with StreamingStandardizer.from_state()
+        """
+        return {"n_samples": self.n_samples,
+                "mean": None if self._mean is None else self._mean.tolist(),
+                "m2": None if self._m2 is None else self._m2.tolist()}
+
+    @classmethod
+    def from_state(cls, state):
+        standardizer = cls()
+        if state["n_samples"] > 0:
+            standardizer._update(state["n_samples"], np.array(state["mean"]), np.array(state["m2"]))
+        return standardizer
 
 
 def matrix_regularization(array_input, axis=0, norm='l2'):
     """
     Regularized input matrix.(正则化)
     :param axis: Regularized dimensions
-    :param array_input: Input numpy.array()
+    :param array_input: Input numpy.array() or scipy.sparse matrix(stays sparse)
     :param norm: Regularized type
     :return: The Regularized matrix.
     """
-    if type(array_input) != np.ndarray:
-        raise TypeError("Data matrix format error！Not numpy.array!")
+    _check_matrix(array_input, allow_sparse=True)
     if axis == 0:
         array_regularization = preprocessing.normalize(array_input.T, norm=norm)
         return array_regularization.T
@@ -88,7 +423,7 @@ def matrix_regularization(array_input, axis=0, norm='l2'):
 def matrix_binarization(data_input, threshold=0.0):
     """
     Data binarization.(二值化)
-    :param data_input: Input data
+    :param data_input: Input data, scipy.sparse matrices stay sparse
     :param threshold: Threshold of binarization(Less than the threshold is zero, the opposite is one)
     :return: Binary data
     """
@@ -104,11 +439,148 @@ def missing_value_processing(array_input, strategy='mean', axis=0):
     :param axis: Missing value processing strategy dimensions.
     :return: Missing value processed matrix.
     """
-    if type(array_input) != np.ndarray:
-        array_input = np.array(array_input)
-    Iop = preprocessing.Imputer(missing_values='NaN', strategy=strategy, axis=axis)
-    array_processed = Iop.fit_transform(array_input)
-    return array_processed
+    if type(array_input) != np.ndarray or not np.issubdtype(array_input.dtype, np.floating):
+        array_input = np.asarray(array_input, dtype=np.float64)
+    if axis == 0:
+        return MissingValueImputer(strategy=strategy).fit_transform(array_input)
+    elif axis == 1:
+        return MissingValueImputer(strategy=strategy).fit_transform(array_input.T).T
+    else:
+        raise ValueError("Axis Value Error!")
+
+
+def _nan_most_frequent(column_block):
+    """
+    :param column_block: Block of columns
+    :return: Most frequent non-NaN value of each column(the smallest one for ties), NaN if none
+    """
+    statistics = np.full(column_block.shape[1], np.nan)
+    for i in range(column_block.shape[1]):
+        column = column_block[:, i]
+        column = column[~np.isnan(column)]
+        if len(column) > 0:
+            uniques, counts = np.unique(column, return_counts=True)
+            statistics[i] = uniques[np.argmax(counts)]
+    return statistics
+
+
+class MissingValueImputer(object):
+    """MissingValueImputer
+
+    Column-wise NaN imputation with persisted statistics.
+        1.fit() computes the statistic of each column, ignoring NaN
+        2.transform() replaces NaN with the statistics, may be applied to new batches
+
+    'mean' is accumulated over row blocks, 'median' and 'most_frequent' read blocks of
+    columns which may be computed in a thread pool, so numpy.memmap inputs larger than
+    memory work. Columns without any value keep NaN.
+
+    Attributes:
+        strategy: 'mean', 'median' or 'most_frequent'
+        statistics: Statistic of each column
+    """
+
+    STRATEGIES = ('mean', 'median', 'most_frequent')
+
+    def __init__(self, strategy='mean'):
+        if strategy not in self.STRATEGIES:
+            raise ValueError("Strategy Value Error!")
+        self.strategy = strategy
+        self.statistics = None
+
+    def fit(self, array_input, block_size=None, max_workers=None):
+        """
+        Compute the statistics
+        :param array_input: Input numpy.array()(float), may be a numpy.memmap
+        :param block_size: Rows per block('mean')
+        :param max_workers: Max Workers of Thread Pool computing column blocks('median', 'most_frequent')
+        :return: self
+        """
+        _check_matrix(array_input)
+        if array_input.ndim != 2:
+            raise ValueError("Data matrix must be 2-D!")
+        if self.strategy == 'mean':
+            total = np.zeros(array_input.shape[1], dtype=np.float64)
+            count = np.zeros(array_input.shape[1], dtype=np.int64)
+            for rows in _row_blocks(array_input, block_size):
+                block = array_input[rows]
+                total += np.nansum(block, axis=0, dtype=np.float64)
+                count += block.shape[0] - np.isnan(block).sum(axis=0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                self.statistics = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+            return self
+        column_bytes = array_input.dtype.itemsize * max(1, array_input.shape[0])
+        column_block_size = max(1, DEFAULT_BLOCK_BYTES // column_bytes)
+        column_blocks = [slice(start, min(start + column_block_size, array_input.shape[1]))
+                         for start in range(0, array_input.shape[1], column_block_size)]
+        statistics = np.full(array_input.shape[1], np.nan)
+
+        def task(columns):
+            column_block = np.asarray(array_input[:, columns], dtype=np.float64)
+            if self.strategy == 'median':
+                if column_block.shape[0] == 0:
+                    return
+                with warnings.catch_warnings():
+                    # All-NaN columns keep NaN
+                    warnings.simplefilter("ignore", RuntimeWarning)
+                    statistics[columns] = np.nanmedian(column_block, axis=0)
+            else:
+                statistics[columns] = _nan_most_frequent(column_block)
+
+        if max_workers is None or max_workers <= 1:
+            for columns in column_blocks:
+                task(columns)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for future in [executor.submit(task, columns) for columns in column_blocks]:
+                    future.result()
+        self.statistics = statistics
+        return self
+
+    def transform(self, array_input, out=None, block_size=None):
+        """
+        Replace NaN with the statistics
+        :param array_input: Input numpy.array()(float), may be a numpy.memmap
+        :param out: Output numpy.array(), pass array_input to impute in place
+        :param block_size: Rows per block
+        :return: Missing value processed matrix
+        """
+        if self.statistics is None:
+            raise ValueError("MissingValueImputer is not fitted!")
+        _check_matrix(array_input)
+        if array_input.ndim != 2 or array_input.shape[1] != len(self.statistics):
+            raise ValueError("Data matrix columns error!")
+        out = _prepare_out(array_input, out)
+        statistics = self.statistics.astype(out.dtype)
+        for rows in _row_blocks(array_input, block_size):
+            block = array_input[rows]
+            mask = np.isnan(block)
+            if out is not array_input:
+                out[rows] = block
+            np.copyto(out[rows], np.broadcast_to(statistics, block.shape), where=mask)
+        return out
+
+    def fit_transform(self, array_input, out=None, block_size=None, max_workers=None):
+        return self.fit(array_input, block_size=block_size, max_workers=max_workers).transform(
+            array_input, out=out, block_size=block_size)
+
+    def save(self, file_path):
+        """
+        Save the statistics to a json file
+        :param file_path: Output json file path
+        :return: None
+        """
+        if self.statistics is None:
+            raise ValueError("MissingValueImputer is not fitted!")
+        file_utils.write_dict_to_json_file({"strategy": self.strategy, "statistics": self.statistics.tolist()},
+                                           file_path)
+
+    @classmethod
+    def load(cls, file_path):
+        state = file_utils.read_json_file_to_dict(file_path)
+        imputer = cls(strategy=state["strategy"])
+        imputer.statistics = np.array(state["statistics"], dtype=np.float64)
+        return imputer
 
 
 def label_encoder(vector):
@@ -132,12 +604,131 @@ def one_hot_encoder(vector, sparse=False):
     :return: Output matrix
     """
     vector = label_encoder(vector)
-    encoder = preprocessing.OneHotEncoder(sparse=sparse)
+    try:
+        encoder = preprocessing.OneHotEncoder(sparse_output=sparse)
+    except TypeError:
+        # scikit-learn < 1.2
+        encoder = preprocessing.OneHotEncoder(sparse=sparse)
     integer_encoded = vector.reshape(len(vector), 1)
     onehot_encoded = encoder.fit_transform(integer_encoded)
     return onehot_encoded
 
 
+class VocabularyEncoder(object):
+    """VocabularyEncoder
+
+    Fitted, serializable category encoder, the same category always maps to the same integer.
+        Vocabulary mode: categories get 1, 2, ... in first seen order, 0 is the unknown bucket.
+                         partial_fit() extends the vocabulary batch by batch.
+        Hashing mode(n_buckets): categories are hashed(pandas.util.hash_array) into buckets 1..n_buckets,
+                                 0 stays the unknown bucket. Memory stays fixed for any number of
+                                 distinct values and no fitting is needed.
+
+    Transforms factorize the batch once(pandas.factorize) and only look up its distinct values.
+
+    Attributes:
+        n_buckets: Number of hash buckets, None for vocabulary mode
+        vocabulary: List of known categories(index i is encoded as i + 1)
+    """
+
+    UNKNOWN = 0
+
+    def __init__(self, n_buckets=None):
+        self.n_buckets = n_buckets
+        self.vocabulary = []
+        self._index = {}
+
+    def __len__(self):
+        """
+        :return: Number of codes(one-hot width), including the unknown bucket
+        """
+        if self.n_buckets is not None:
+            return self.n_buckets + 1
+        return len(self.vocabulary) + 1
+
+    def fit(self, values):
+        self.vocabulary = []
+        self._index = {}
+        return self.partial_fit(values)
+
+    def partial_fit(self, values):
+        """
+        Add the unseen categories of a batch to the vocabulary
+        :param values: Input vector
+        :return: self
+        """
+        if self.n_buckets is not None:
+            return self
+        _, uniques = pd.factorize(np.asarray(values, dtype=object).ravel())
+        for value in uniques.tolist():
+            if value not in self._index:
+                self._index[value] = len(self.vocabulary) + 1
+                self.vocabulary.append(value)
+        return self
+
+    def _encode_uniques(self, uniques):
+        if self.n_buckets is not None:
+            # Hashed by their text, so 1 and "1" share a bucket
+            text = np.array(["{}".format(value) for value in uniques], dtype=object)
+            hashes = pd.util.hash_array(text, categorize=False)
+            return (hashes % np.uint64(self.n_buckets)).astype(np.int64) + 1
+        return np.fromiter((self._index.get(value, self.UNKNOWN) for value in uniques),
+                           dtype=np.int64, count=len(uniques))
+
+    def transform(self, values):
+        """
+        Encode categories to integers, unknown and missing values go to the unknown bucket(0)
+        :param values: Input vector
+        :return: Integer vector
+        """
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object).ravel())
+        # One extra slot for missing values, factorize codes them -1
+        mapping = np.append(self._encode_uniques(uniques.tolist()), self.UNKNOWN)
+        return mapping[codes]
+
+    def fit_transform(self, values):
+        return self.fit(values).transform(values)
+
+    def inverse_transform(self, codes):
+        """
+        Decode integers to categories, the unknown bucket decodes to None(vocabulary mode only)
+        :param codes: Integer vector
+        :return: Object vector
+        """
+        if self.n_buckets is not None:
+            raise ValueError("Hashing mode can not be inverted!")
+        vocabulary = np.empty(len(self.vocabulary) + 1, dtype=object)
+        vocabulary[1:] = self.vocabulary
+        return vocabulary[np.asarray(codes)]
+
+    def transform_one_hot(self, values, sparse_output=True):
+        """
+        One-hot coding with one column per code(len(self) columns)
+        :param values: Input vector
+        :param sparse_output: Whether a scipy.sparse.csr_matrix is returned
+        :return: Output matrix
+        """
+        codes = self.transform(values)
+        one_hot = sparse.csr_matrix((np.ones(len(codes)), (np.arange(len(codes)), codes)),
+                                    shape=(len(codes), len(self)))
+        return one_hot if sparse_output else one_hot.toarray()
+
+    def save(self, file_path):
+        """
+        Save the encoder to a json file
+        :param file_path: Output json file path
+        :return: None
+        """
+        file_utils.write_dict_to_json_file({"n_buckets": self.n_buckets, "vocabulary": self.vocabulary}, file_path)
+
+    @classmethod
+    def load(cls, file_path):
+        state = file_utils.read_json_file_to_dict(file_path)
+        encoder = cls(n_buckets=state["n_buckets"])
+        encoder.partial_fit(state["vocabulary"])
+        return encoder
+
+
 def calculate_vector_cosine_similarity(embedding_a, embedding_b):
     """
     Calculate vector cosine_similarity
@@ -158,28 +749,769 @@ def calculate_vector_euclidean_distance(embedding_a, embedding_b):
     :return: Distance
     """
     diff = np.subtract(embedding_a, embedding_b)
-    dist = np.sum(np.square(diff), 1)
+    dist = np.sum(np.square(diff), -1)
     return dist
 
 
-def calculate_matrix_cosine_similarity(matrix_a, matrix_b):
+def calculate_row_norms(matrix):
     """
-    Calculate matrix cosine_similarity
+    l2 norm of each row, reusable by the batched similarity functions
+    :param matrix: Input matrix
+    :return: Norms vector
+    """
+    return np.sqrt(_row_squared_norms(_as_matrix(matrix)))
+
+
+def _cosine_from_dot(dot, norms_a, norms_b, scaled):
+    denominator = norms_a * norms_b
+    # Zero vectors have zero cosine like sklearn
+    cos = np.divide(dot, denominator, out=np.zeros_like(dot, dtype=np.float64), where=denominator != 0)
+    if scaled:
+        return 0.5 + 0.5 * cos
+    return cos
+
+
+def calculate_paired_cosine_similarity(matrix_a, matrix_b, scaled=True):
+    """
+    Cosine similarity of aligned pairs(a[i] vs b[i]) in one call
     :param matrix_a: Matrix a
-    :param matrix_b: Matrix b
+    :param matrix_b: Matrix b, same shape as matrix a
+    :param scaled: Whether to scale to [0, 1] like calculate_vector_cosine_similarity(0.5 + 0.5 * cos)
+    :return: Similarity vector
+    """
+    matrix_a, matrix_b = _as_matrix(matrix_a), _as_matrix(matrix_b)
+    if matrix_a.shape != matrix_b.shape:
+        raise ValueError("Data matrix shape error!")
+    dot = _row_dot(matrix_a, matrix_b)
+    return _cosine_from_dot(dot, calculate_row_norms(matrix_a), calculate_row_norms(matrix_b), scaled)
+
+
+def calculate_paired_euclidean_distance(matrix_a, matrix_b, squared=True):
+    """
+    Euclidean distance of aligned pairs(a[i] vs b[i]) in one call
+    :param matrix_a: Matrix a
+    :param matrix_b: Matrix b, same shape as matrix a
+    :param squared: Whether to return the squared distance like calculate_vector_euclidean_distance
+    :return: Distance vector
+    """
+    matrix_a, matrix_b = _as_matrix(matrix_a), _as_matrix(matrix_b)
+    if matrix_a.shape != matrix_b.shape:
+        raise ValueError("Data matrix shape error!")
+    diff = matrix_a - matrix_b
+    dist = _row_dot(diff, diff)
+    if squared:
+        return dist
+    return np.sqrt(dist)
+
+
+class VectorReference(object):
+    """VectorReference
+
+    Reference vectors with precomputed norms, scored against one or many vectors per call.
+        ref = VectorReference(gallery)
+        ref.cosine_similarity(vector)  # shape (len(gallery),)
+        ref.cosine_similarity(batch)   # shape (len(batch), len(gallery))
+
+    Attributes:
+        matrix: Reference vectors
+        norms: l2 norm of each reference vector
+    """
+
+    def __init__(self, matrix):
+        self.matrix = _as_matrix(matrix)
+        self.norms = calculate_row_norms(self.matrix)
+        self._squared_norms = np.square(self.norms)
+
+    def cosine_similarity(self, vectors, scaled=True):
+        """
+        :param vectors: Vector or matrix of vectors
+        :param scaled: Whether to scale to [0, 1](0.5 + 0.5 * cos)
+        :return: Similarity vector(or matrix, one row per input vector)
+        """
+        is_vector = not _is_sparse(vectors) and np.ndim(vectors) == 1
+        vectors = _as_matrix(vectors)
+        dot = np.asarray(_to_dense(vectors @ self.matrix.T), dtype=np.float64)
+        sim = _cosine_from_dot(dot, calculate_row_norms(vectors)[:, None], self.norms[None, :], scaled)
+        return sim[0] if is_vector else sim
+
+    def euclidean_distance(self, vectors, squared=True):
+        """
+        :param vectors: Vector or matrix of vectors
+        :param squared: Whether to return the squared distance
+        :return: Distance vector(or matrix, one row per input vector)
+        """
+        is_vector = not _is_sparse(vectors) and np.ndim(vectors) == 1
+        vectors = _as_matrix(vectors)
+        dot = np.asarray(_to_dense(vectors @ self.matrix.T), dtype=np.float64)
+        dist = _row_squared_norms(vectors)[:, None] - 2 * dot + self._squared_norms[None, :]
+        np.maximum(dist, 0, out=dist)
+        if not squared:
+            dist = np.sqrt(dist)
+        return dist[0] if is_vector else dist
+
+
+def calculate_matrix_cosine_similarity(matrix_a, matrix_b, dense_output=True):
+    """
+    Calculate matrix cosine_similarity
+    :param matrix_a: Matrix a(numpy.array() or scipy.sparse matrix)
+    :param matrix_b: Matrix b(numpy.array() or scipy.sparse matrix)
+    :param dense_output: Whether to return a dense result when both inputs are sparse
     :return: Similarity
     """
-    return cosine_similarity(matrix_a, matrix_b)
+    return pairwise.cosine_similarity(matrix_a, matrix_b, dense_output=dense_output)
 
 
 def calculate_matrix_euclidean_distance(matrix_a, matrix_b):
     """
     Calculate matrix euclidean_distance
-    :param matrix_a: Matrix a
-    :param matrix_b: Matrix b
+    :param matrix_a: Matrix a(numpy.array() or scipy.sparse matrix)
+    :param matrix_b: Matrix b(numpy.array() or scipy.sparse matrix)
     :return: Distance
     """
-    return euclidean_distances(matrix_a, matrix_b)
+    return pairwise.euclidean_distances(matrix_a, matrix_b)
+
+
+def _row_squared_norms(matrix, block_size=None):
+    """
+    :param matrix: Input matrix
+    :param block_size: Rows per block
+    :return: Squared l2 norm of each row(float64)
+    """
+    if _is_sparse(matrix):
+        matrix = matrix.astype(np.float64)
+        return np.asarray(matrix.multiply(matrix).sum(axis=1), dtype=np.float64).ravel()
+    norms = np.empty(matrix.shape[0], dtype=np.float64)
+    for rows in _row_blocks(matrix, block_size):
+        block = np.asarray(matrix[rows], dtype=np.float64)
+        norms[rows] = np.einsum("ij,ij->i", block, block)
+    return norms
+
+
+def _take_rows(array, columns):
+    """
+    array[i, columns[i]] for each row, np.take_along_axis needs numpy>=1.15
+    """
+    return array[np.arange(array.shape[0])[:, None], columns]
+
+
+def _select_topk(index, score, k, largest=True):
+    """
+    Keep the k best candidates of each row with partial selection(unsorted)
+    :param index: Candidate indices, shape (n, c)
+    :param score: Candidate scores, shape (n, c)
+    :param k: Number of candidates to keep
+    :param largest: Whether larger scores are better
+    :return: [indices, scores], shape (n, min(k, c))
+    """
+    if score.shape[1] <= k:
+        return index, score
+    part = np.argpartition(-score if largest else score, k - 1, axis=1)[:, :k]
+    return _take_rows(index, part), _take_rows(score, part)
+
+
+def _merge_topk(best_index, best_score, index, score, k, largest=True):
+    """
+    Merge new candidates into the running top-k of each row
+    :return: [indices, scores]
+    """
+    if best_index is not None:
+        index = np.concatenate([best_index, index], axis=1)
+        score = np.concatenate([best_score, score], axis=1)
+    return _select_topk(index, score, k, largest)
+
+
+def _sort_topk(index, score, largest=True):
+    # mergesort is the stable sort of numpy<1.15
+    order = np.argsort(-score if largest else score, axis=1, kind="mergesort")
+    return _take_rows(index, order), _take_rows(score, order)
+
+
+def _block_scores(queries, query_norms, gallery, gallery_norms, metric):
+    """
+    Scores of a query block against a gallery block
+    :param queries: Query rows
+    :param query_norms: Squared norms of the queries
+    :param gallery: Gallery rows
+    :param gallery_norms: Squared norms of the gallery rows
+    :param metric: 'cosine' or 'euclidean'
+    :return: Cosine similarity, or squared euclidean distance
+    """
+    scores = _to_dense(queries @ gallery.T)
+    if metric == "cosine":
+        # Zero vectors have zero similarity like sklearn
+        denominator = np.sqrt(np.outer(query_norms, gallery_norms))
+        denominator[denominator == 0] = 1
+        scores /= denominator
+    else:
+        scores *= -2
+        scores += query_norms[:, None]
+        scores += gallery_norms[None, :]
+        np.maximum(scores, 0, out=scores)
+    return scores
+
+
+def _blocked_topk(matrix_a, n_gallery, k, largest, prepare_queries, score_block, block_size=None,
+                  query_block_size=None, max_workers=None):
+    """
+    Generic blocked top-k search
+    :param matrix_a: Queries
+    :param n_gallery: Number of gallery rows
+    :param k: Number of results per query
+    :param largest: Whether larger scores are better
+    :param prepare_queries: Function(query rows) -> prepared queries, called once per query block
+    :param score_block: Function(prepared queries, gallery row slice) -> dense scores
+    :param block_size: Gallery rows per block
+    :param query_block_size: Query rows per block
+    :param max_workers: Max Workers of Thread Pool running query blocks
+    :return: [indices, scores], best first
+    """
+    if block_size is None:
+        block_size = DEFAULT_TOPK_BLOCK_SIZE
+    if query_block_size is None:
+        query_block_size = DEFAULT_TOPK_BLOCK_SIZE
+    k = min(k, n_gallery)
+    if k == 0:
+        return np.empty((matrix_a.shape[0], 0), dtype=np.int64), np.empty((matrix_a.shape[0], 0))
+    results = {}
+
+    def task(query_rows):
+        queries = prepare_queries(matrix_a[query_rows])
+        best_index, best_score = None, None
+        for start in range(0, n_gallery, block_size):
+            rows = slice(start, min(start + block_size, n_gallery))
+            scores = score_block(queries, rows)
+            index = np.broadcast_to(np.arange(rows.start, rows.stop), scores.shape)
+            index, scores = _select_topk(index, scores, k, largest)
+            best_index, best_score = _merge_topk(best_index, best_score, index, scores, k, largest)
+        results[query_rows.start] = _sort_topk(best_index, best_score, largest)
+
+    blocks = list(_row_blocks(matrix_a, query_block_size))
+    if max_workers is None or max_workers <= 1:
+        for query_rows in blocks:
+            task(query_rows)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for future in [executor.submit(task, query_rows) for query_rows in blocks]:
+                future.result()
+    if len(blocks) == 0:
+        return np.empty((0, k), dtype=np.int64), np.empty((0, k))
+    indices = np.concatenate([results[query_rows.start][0] for query_rows in blocks])
+    scores = np.concatenate([results[query_rows.start][1] for query_rows in blocks])
+    return indices, scores
+
+
+def calculate_matrix_topk(matrix_a, matrix_b, k=10, metric="cosine", block_size=None, query_block_size=None,
+                          max_workers=None):
+    """
+    Top-k most similar rows of matrix b for each row of matrix a, without building the dense N x M matrix.
+    Query and gallery rows are processed in blocks with bounded memory,
+    query blocks run in a thread pool.
+    :param matrix_a: Matrix a(queries), may be a scipy.sparse matrix
+    :param matrix_b: Matrix b(gallery), may be a numpy.memmap or a scipy.sparse matrix
+    :param k: Number of results per row
+    :param metric: 'cosine'(same as calculate_matrix_cosine_similarity) or
+                   'euclidean'(same as calculate_matrix_euclidean_distance)
+    :param block_size: Gallery rows per block
+    :param query_block_size: Query rows per block
+    :param max_workers: Max Workers of Thread Pool, None runs in the caller thread
+    :return: [indices, scores], shape (len(matrix_a), k), best first
+    """
+    if metric not in ("cosine", "euclidean"):
+        raise ValueError("Metric Value Error!")
+    matrix_a = matrix_a if isinstance(matrix_a, np.ndarray) else _as_matrix(matrix_a)
+    matrix_b = matrix_b if isinstance(matrix_b, np.ndarray) else _as_matrix(matrix_b)
+    dtype = np.result_type(matrix_a.dtype, matrix_b.dtype, np.float32)
+    gallery_norms = _row_squared_norms(matrix_b).astype(dtype)
+
+    def prepare_queries(queries):
+        queries = _as_matrix(queries, dtype=dtype)
+        return queries, _row_squared_norms(queries).astype(dtype)
+
+    def score_block(queries, rows):
+        gallery = _as_matrix(matrix_b[rows], dtype=dtype)
+        return _block_scores(queries[0], queries[1], gallery, gallery_norms[rows], metric)
+
+    indices, scores = _blocked_topk(matrix_a, matrix_b.shape[0], k, metric == "cosine", prepare_queries,
+                                    score_block, block_size, query_block_size, max_workers)
+    if metric == "euclidean":
+        scores = np.sqrt(scores)
+    return indices, scores.astype(dtype, copy=False)
+
+
+def _kmeans(matrix, n_clusters, metric="euclidean", n_iter=20, seed=0):
+    """
+    Lloyd k-means, spherical k-means if metric is 'cosine'
+    :param matrix: Training rows
+    :param n_clusters: Number of centroids
+    :param metric: 'cosine' or 'euclidean'
+    :param n_iter: Number of iterations
+    :param seed: Random seed
+    :return: Centroids, shape (n_clusters, dim)
+    """
+    rng = np.random.RandomState(seed)
+    data = np.asarray(matrix, dtype=np.float32)
+    if metric == "cosine":
+        data = data / np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-12)
+    n_clusters = min(n_clusters, data.shape[0])
+    centroids = data[rng.choice(data.shape[0], n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = calculate_matrix_topk(data, centroids, k=1, metric=metric)[0][:, 0]
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Restart empty clusters from random rows
+        centroids[empty] = data[rng.choice(data.shape[0], int(empty.sum()))]
+        if metric == "cosine":
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+
+class IVFIndex(object):
+    """IVFIndex
+
+    Approximate nearest neighbour index(inverted file).
+        1.train() the coarse quantizer(k-means) on a sample
+        2.add() vectors, may be called repeatedly
+        3.search() probes the n_probe closest lists and re-ranks their vectors exactly
+
+    Scores follow calculate_matrix_cosine_similarity / calculate_matrix_euclidean_distance.
+    save() writes one .npy file per array, load() memory-maps them so serving processes
+    share one copy through the page cache.
+
+    Attributes:
+        n_lists: Number of inverted lists(centroids)
+        metric: 'cosine' or 'euclidean'
+        n_probe: Default number of lists probed per query
+        centroids: Coarse quantizer centroids
+    """
+
+    def __init__(self, n_lists=256, metric="cosine", n_probe=8):
+        if metric not in ("cosine", "euclidean"):
+            raise ValueError("Metric Value Error!")
+        self.n_lists = n_lists
+        self.metric = metric
+        self.n_probe = n_probe
+        self.centroids = None
+        # Per list: list of [vectors, ids, squared norms] segments
+        self._lists = None
+        self._next_id = 0
+
+    def __len__(self):
+        if self._lists is None:
+            return 0
+        return sum(len(ids) for segments in self._lists for _, ids, _ in segments)
+
+    def train(self, matrix, n_iter=20, sample_size=100000, seed=0):
+        """
+        Train the coarse quantizer
+        :param matrix: Training vectors
+        :param n_iter: k-means iterations
+        :param sample_size: Max number of rows used
+        :param seed: Random seed
+        :return: self
+        """
+        if matrix.shape[0] > sample_size:
+            sample = np.random.RandomState(seed).choice(matrix.shape[0], sample_size, replace=False)
+            matrix = matrix[np.sort(sample)]
+        self.centroids = _kmeans(matrix, self.n_lists, metric=self.metric, n_iter=n_iter, seed=seed)
+        self.n_lists = self.centroids.shape[0]
+        self._lists = [[] for _ in range(self.n_lists)]
+        return self
+
+    def add(self, matrix, ids=None):
+        """
+        Add vectors to the index
+        :param matrix: Vectors
+        :param ids: Integer ids, default continues from the last added id
+        :return: Ids of the added vectors
+        """
+        if self.centroids is None:
+            raise ValueError("IVFIndex is not trained!")
+        vectors = np.asarray(matrix, dtype=np.float32)
+        if ids is None:
+            ids = np.arange(self._next_id, self._next_id + vectors.shape[0], dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) != vectors.shape[0]:
+            raise ValueError("Ids length error!")
+        if len(ids) > 0:
+            self._next_id = max(self._next_id, int(ids.max()) + 1)
+        assignment = calculate_matrix_topk(vectors, self.centroids, k=1, metric=self.metric)[0][:, 0]
+        norms = _row_squared_norms(vectors)
+        order = np.argsort(assignment, kind="mergesort")
+        bounds = np.searchsorted(assignment[order], np.arange(self.n_lists + 1))
+        for list_id in np.nonzero(np.diff(bounds))[0]:
+            rows = order[bounds[list_id]:bounds[list_id + 1]]
+            self._lists[list_id].append([vectors[rows], ids[rows], norms[rows]])
+        return ids
+
+    def search(self, queries, k=10, n_probe=None):
+        """
+        Approximate top-k search
+        :param queries: Query vectors
+        :param k: Number of results per query
+        :param n_probe: Number of lists probed per query
+        :return: [ids, scores], shape (len(queries), k), best first. Missing results have id -1
+        """
+        if self.centroids is None:
+            raise ValueError("IVFIndex is not trained!")
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries.reshape(1, -1)
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        largest = self.metric == "cosine"
+        probe = calculate_matrix_topk(queries, self.centroids, k=n_probe, metric=self.metric)[0]
+        query_norms = _row_squared_norms(queries).astype(np.float32)
+        best_ids = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        best_scores = np.full((queries.shape[0], k), -np.inf if largest else np.inf, dtype=np.float32)
+        # Group the queries by probed list, so each list is scored with one matrix product
+        flat_lists = probe.ravel()
+        order = np.argsort(flat_lists, kind="mergesort")
+        bounds = np.searchsorted(flat_lists[order], np.arange(self.n_lists + 1))
+        for list_id in np.nonzero(np.diff(bounds))[0]:
+            rows = order[bounds[list_id]:bounds[list_id + 1]] // n_probe
+            for vectors, ids, norms in self._lists[list_id]:
+                if len(ids) == 0:
+                    continue
+                scores = _block_scores(queries[rows], query_norms[rows], np.asarray(vectors),
+                                       np.asarray(norms, dtype=np.float32), self.metric)
+                index, scores = _select_topk(np.broadcast_to(ids, scores.shape), scores, k, largest)
+                best_ids[rows], best_scores[rows] = _merge_topk(best_ids[rows], best_scores[rows],
+                                                                index, scores, k, largest)
+        best_ids, best_scores = _sort_topk(best_ids, best_scores, largest)
+        if self.metric == "euclidean":
+            best_scores = np.sqrt(best_scores)
+        return best_ids, best_scores
+
+    def _all_vectors(self):
+        vectors, ids = [], []
+        for segments in self._lists:
+            for segment_vectors, segment_ids, _ in segments:
+                vectors.append(np.asarray(segment_vectors))
+                ids.append(np.asarray(segment_ids))
+        return np.concatenate(vectors), np.concatenate(ids)
+
+    def recall(self, queries, k=10, n_probes=(1, 2, 4, 8, 16)):
+        """
+        Recall@k of search() against exact search(calculate_matrix_topk) over the indexed vectors
+        :param queries: Query vectors
+        :param k: Number of results per query
+        :param n_probes: List of n_probe values to evaluate
+        :return: Dict of n_probe -> recall@k
+        """
+        vectors, ids = self._all_vectors()
+        exact = ids[calculate_matrix_topk(queries, vectors, k=k, metric=self.metric)[0]]
+        result = {}
+        for n_probe in n_probes:
+            approximate = self.search(queries, k=k, n_probe=n_probe)[0]
+            hits = sum(len(np.intersect1d(a, e)) for a, e in zip(approximate, exact))
+            result[n_probe] = hits / exact.size
+        return result
+
+    def save(self, path):
+        """
+        Save the index to a directory, segments are merged into contiguous arrays sorted by list
+        :param path: Output directory
+        :return: None
+        """
+        if self.centroids is None:
+            raise ValueError("IVFIndex is not trained!")
+        if not os.path.exists(path):
+            os.makedirs(path)
+        dim = self.centroids.shape[1]
+        vectors, ids, norms, offsets = [], [], [], [0]
+        for segments in self._lists:
+            for segment_vectors, segment_ids, segment_norms in segments:
+                vectors.append(np.asarray(segment_vectors))
+                ids.append(np.asarray(segment_ids))
+                norms.append(np.asarray(segment_norms))
+            offsets.append(offsets[-1] + sum(len(segment[1]) for segment in segments))
+        np.save(os.path.join(path, "centroids.npy"), self.centroids)
+        np.save(os.path.join(path, "vectors.npy"),
+                np.concatenate(vectors) if vectors else np.empty((0, dim), dtype=np.float32))
+        np.save(os.path.join(path, "ids.npy"), np.concatenate(ids) if ids else np.empty(0, dtype=np.int64))
+        np.save(os.path.join(path, "norms.npy"), np.concatenate(norms) if norms else np.empty(0))
+        np.save(os.path.join(path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"metric": self.metric, "n_probe": self.n_probe, "next_id": self._next_id}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load an index saved by save()
+        :param path: Index directory
+        :param mmap: Whether to memory-map the vectors instead of reading them
+        :return: IVFIndex object
+        """
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        centroids = np.load(os.path.join(path, "centroids.npy"))
+        index = cls(n_lists=centroids.shape[0], metric=meta["metric"], n_probe=meta["n_probe"])
+        index.centroids = centroids
+        index._next_id = meta["next_id"]
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode=mmap_mode)
+        ids = np.load(os.path.join(path, "ids.npy"), mmap_mode=mmap_mode)
+        norms = np.load(os.path.join(path, "norms.npy"), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(path, "offsets.npy"))
+        index._lists = [[[vectors[start:end], ids[start:end], norms[start:end]]] if end > start else []
+                        for start, end in zip(offsets[:-1], offsets[1:])]
+        return index
+
+
+class ScalarQuantizer(object):
+    """ScalarQuantizer
+
+    Compressed embedding storage with float16(2x) or int8(4x against float32) codes.
+        1.fit() the per dimension int8 scales(not needed for float16)
+        2.encode() the gallery, keep only the codes
+        3.search() scores queries against the codes block by block, the gallery is never
+          decompressed as a whole(int8 codes are scored as (query * scale) . codes)
+
+    Attributes:
+        dtype: 'float16' or 'int8'
+        metric: 'cosine' or 'euclidean'
+        scale: Per dimension int8 scale
+    """
+
+    def __init__(self, dtype="int8", metric="cosine"):
+        if dtype not in ("float16", "int8"):
+            raise ValueError("Quantizer dtype Value Error!")
+        if metric not in ("cosine", "euclidean"):
+            raise ValueError("Metric Value Error!")
+        self.dtype = dtype
+        self.metric = metric
+        self.scale = None
+
+    def fit(self, matrix, block_size=None):
+        """
+        :param matrix: Training vectors
+        :param block_size: Rows per block
+        :return: self
+        """
+        if self.dtype == "int8":
+            max_abs = None
+            for rows in _row_blocks(matrix, block_size):
+                block_max = np.abs(np.asarray(matrix[rows], dtype=np.float32)).max(axis=0)
+                max_abs = block_max if max_abs is None else np.maximum(max_abs, block_max)
+            self.scale = np.where(max_abs == 0, 1, max_abs / 127).astype(np.float32)
+        return self
+
+    def encode(self, matrix, block_size=None):
+        """
+        :param matrix: Vectors
+        :param block_size: Rows per block
+        :return: Codes
+        """
+        if self.dtype == "float16":
+            return np.asarray(matrix, dtype=np.float16)
+        if self.scale is None:
+            raise ValueError("ScalarQuantizer is not fitted!")
+        codes = np.empty(matrix.shape, dtype=np.int8)
+        for rows in _row_blocks(matrix, block_size):
+            block = np.asarray(matrix[rows], dtype=np.float32) / self.scale
+            codes[rows] = np.clip(np.rint(block), -127, 127)
+        return codes
+
+    def decode(self, codes):
+        """
+        :param codes: Codes
+        :return: Approximate float32 vectors
+        """
+        if self.dtype == "float16":
+            return np.asarray(codes, dtype=np.float32)
+        return codes.astype(np.float32) * self.scale
+
+    def search(self, queries, codes, k=10, block_size=None, query_block_size=None, max_workers=None):
+        """
+        Top-k search against the codes, same semantics as calculate_matrix_topk
+        :param queries: Query vectors(float)
+        :param codes: Codes from encode()
+        :param k: Number of results per query
+        :param block_size: Gallery rows per block
+        :param query_block_size: Query rows per block
+        :param max_workers: Max Workers of Thread Pool
+        :return: [indices, scores], best first
+        """
+        queries = _as_matrix(queries, dtype=np.float32)
+        gallery_norms = np.empty(codes.shape[0], dtype=np.float32)
+        for rows in _row_blocks(codes, block_size):
+            gallery_norms[rows] = _row_squared_norms(self.decode(codes[rows]))
+
+        def prepare_queries(query_block):
+            query_norms = _row_squared_norms(query_block).astype(np.float32)
+            # Fold the int8 scale into the queries instead of decoding the codes
+            scaled = query_block if self.dtype == "float16" else query_block * self.scale
+            return scaled, query_norms
+
+        def score_block(prepared, rows):
+            return _block_scores(prepared[0], prepared[1], codes[rows].astype(np.float32), gallery_norms[rows],
+                                 self.metric)
+
+        indices, scores = _blocked_topk(queries, codes.shape[0], k, self.metric == "cosine", prepare_queries,
+                                        score_block, block_size, query_block_size, max_workers)
+        if self.metric == "euclidean":
+            scores = np.sqrt(scores)
+        return indices, scores
+
+
+class ProductQuantizer(object):
+    """ProductQuantizer
+
+    Product quantization: each vector is split into n_subvectors parts and each part is
+    replaced by the uint8 index of its closest centroid(n_subvectors bytes per vector).
+        search() uses lookup tables(asymmetric distance computation): for each query the
+        scores of its parts against all centroids are computed once, the score of a code is
+        then the sum of n_subvectors table lookups.
+
+    Attributes:
+        n_subvectors: Number of parts, must divide the dimension
+        n_centroids: Centroids per part(at most 256)
+        metric: 'cosine' or 'euclidean'
+        codebooks: Centroids, shape (n_subvectors, n_centroids, dim / n_subvectors)
+    """
+
+    def __init__(self, n_subvectors=8, n_centroids=256, metric="cosine"):
+        if not 1 <= n_centroids <= 256:
+            raise ValueError("n_centroids must be in [1, 256]!")
+        if metric not in ("cosine", "euclidean"):
+            raise ValueError("Metric Value Error!")
+        self.n_subvectors = n_subvectors
+        self.n_centroids = n_centroids
+        self.metric = metric
+        self.codebooks = None
+
+    def _split(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if matrix.shape[1] % self.n_subvectors != 0:
+            raise ValueError("Dimension must be divisible by n_subvectors!")
+        return matrix.reshape(matrix.shape[0], self.n_subvectors, -1)
+
+    def fit(self, matrix, n_iter=20, sample_size=100000, seed=0):
+        """
+        Train one k-means codebook per part
+        :param matrix: Training vectors
+        :param n_iter: k-means iterations
+        :param sample_size: Max number of rows used
+        :param seed: Random seed
+        :return: self
+        """
+        if matrix.shape[0] > sample_size:
+            sample = np.random.RandomState(seed).choice(matrix.shape[0], sample_size, replace=False)
+            matrix = matrix[np.sort(sample)]
+        parts = self._split(matrix)
+        codebooks = np.zeros((self.n_subvectors, self.n_centroids, parts.shape[2]), dtype=np.float32)
+        for j in range(self.n_subvectors):
+            centroids = _kmeans(parts[:, j], self.n_centroids, metric="euclidean", n_iter=n_iter, seed=seed + j)
+            codebooks[j, :len(centroids)] = centroids
+        self.codebooks = codebooks
+        return self
+
+    def encode(self, matrix, block_size=None):
+        """
+        :param matrix: Vectors
+        :param block_size: Rows per block
+        :return: uint8 codes, shape (len(matrix), n_subvectors)
+        """
+        if self.codebooks is None:
+            raise ValueError("ProductQuantizer is not fitted!")
+        codes = np.empty((matrix.shape[0], self.n_subvectors), dtype=np.uint8)
+        for rows in _row_blocks(matrix, block_size):
+            parts = self._split(matrix[rows])
+            for j in range(self.n_subvectors):
+                codes[rows, j] = calculate_matrix_topk(parts[:, j], self.codebooks[j], k=1,
+                                                       metric="euclidean")[0][:, 0]
+        return codes
+
+    def decode(self, codes):
+        """
+        :param codes: uint8 codes
+        :return: Approximate float32 vectors
+        """
+        parts = [self.codebooks[j][codes[:, j]] for j in range(self.n_subvectors)]
+        return np.concatenate(parts, axis=1)
+
+    def search(self, queries, codes, k=10, block_size=None, query_block_size=None, max_workers=None):
+        """
+        Top-k search against the codes with lookup tables, same semantics as calculate_matrix_topk
+        :param queries: Query vectors(float)
+        :param codes: Codes from encode()
+        :param k: Number of results per query
+        :param block_size: Gallery rows per block
+        :param query_block_size: Query rows per block
+        :param max_workers: Max Workers of Thread Pool
+        :return: [indices, scores], best first
+        """
+        if self.codebooks is None:
+            raise ValueError("ProductQuantizer is not fitted!")
+        queries = np.asarray(queries, dtype=np.float32)
+        subspaces = np.arange(self.n_subvectors)
+        # Squared norm of every code, from the squared norms of the centroids
+        centroid_norms = np.einsum("mcd,mcd->mc", self.codebooks, self.codebooks)
+        if query_block_size is None:
+            query_block_size = 256
+
+        def prepare_queries(query_block):
+            parts = self._split(query_block)
+            # (n_subvectors, n_queries, n_centroids)
+            dot_tables = np.einsum("qmd,mcd->mqc", parts, self.codebooks)
+            if self.metric == "cosine":
+                return dot_tables, np.sqrt(_row_squared_norms(query_block))
+            part_norms = np.einsum("qmd,qmd->mq", parts, parts)
+            return part_norms[:, :, None] - 2 * dot_tables + centroid_norms[:, None, :], None
+
+        def score_block(prepared, rows):
+            tables, query_norms = prepared
+            block_codes = codes[rows]
+            scores = np.zeros((tables.shape[1], block_codes.shape[0]), dtype=np.float32)
+            for j in subspaces:
+                scores += tables[j][:, block_codes[:, j]]
+            if self.metric == "cosine":
+                code_norms = np.sqrt(centroid_norms[subspaces, block_codes].sum(axis=1))
+                denominator = np.outer(query_norms, code_norms)
+                denominator[denominator == 0] = 1
+                scores /= denominator
+            else:
+                np.maximum(scores, 0, out=scores)
+            return scores
+
+        indices, scores = _blocked_topk(queries, codes.shape[0], k, self.metric == "cosine", prepare_queries,
+                                        score_block, block_size, query_block_size, max_workers)
+        if self.metric == "euclidean":
+            scores = np.sqrt(scores)
+        return indices, scores
+
+
+def quantization_report(quantizer, queries, matrix, k=10, codes=None):
+    """
+    Accuracy loss of a fitted quantizer against exact float32 search
+    :param quantizer: Fitted ScalarQuantizer or ProductQuantizer
+    :param queries: Query vectors
+    :param matrix: Gallery vectors(float)
+    :param k: Number of results per query
+    :param codes: Codes of the gallery, encoded if None
+    :return: Dict of recall@k, mean/max absolute error of the returned scores against their exact
+             float32 scores, and the compression ratio against float32
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if codes is None:
+        codes = quantizer.encode(matrix)
+    exact_index, _ = calculate_matrix_topk(queries, matrix, k=k, metric=quantizer.metric)
+    index, scores = quantizer.search(queries, codes, k=k)
+    hits = sum(len(np.intersect1d(a, e)) for a, e in zip(index, exact_index))
+    if quantizer.metric == "cosine":
+        exact_scores = calculate_paired_cosine_similarity(np.repeat(queries, index.shape[1], axis=0),
+                                                          matrix[index.ravel()], scaled=False)
+    else:
+        exact_scores = calculate_paired_euclidean_distance(np.repeat(queries, index.shape[1], axis=0),
+                                                           matrix[index.ravel()], squared=False)
+    error = np.abs(scores.ravel() - exact_scores)
+    return {"recall": hits / exact_index.size,
+            "mean_abs_error": float(error.mean()) if error.size else 0.0,
+            "max_abs_error": float(error.max()) if error.size else 0.0,
+            "compression": matrix.nbytes / codes.nbytes}
 
 
 if __name__ == "__main__":
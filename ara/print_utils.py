@@ -13,10 +13,24 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import threading
+import multiprocessing
+
 from tqdm import tqdm
 
 
 class SimpleProgressBar(tqdm):
+    """SimpleProgressBar
+
+    tqdm with low overhead defaults:
+        refreshes at most every 0.5s and is disabled(iterating the raw iterable)
+        when the output is not a TTY.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("mininterval", 0.5)
+        kwargs.setdefault("disable", None)
+        super(SimpleProgressBar, self).__init__(*args, **kwargs)
 
     def show_title(self, text):
         self.set_description_str(text)
@@ -44,3 +58,94 @@ class TqdmUpTo(tqdm):
         if tsize is not None:
             self.total = tsize
         self.update(b * bsize - self.n)
+
+
+class _ThreadCounter(object):
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def update(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class _ProcessCounter(object):
+    """Picklable counter shared by processes through a multiprocessing.Manager"""
+
+    def __init__(self, manager):
+        self._value = manager.Value("q", 0)
+        self._lock = manager.Lock()
+
+    @property
+    def value(self):
+        return self._value.value
+
+    def update(self, n=1):
+        with self._lock:
+            self._value.value += n
+
+
+class MultiWorkerProgress(object):
+    """MultiWorkerProgress
+
+    One progress bar aggregating the counts of many threads or processes.
+        Workers call update(n), or counter.update(n) in worker processes,
+        a background thread refreshes the bar with the overall throughput and ETA.
+
+    Attributes:
+        bar: SimpleProgressBar object
+        counter: Shared counter, pass it to worker processes(update it per batch, each call is an IPC)
+        interval: Seconds between refreshes
+    """
+
+    def __init__(self, total=None, desc=None, interval=0.5, processes=False, disable=None, **kwargs):
+        self.bar = SimpleProgressBar(total=total, mininterval=interval, disable=disable, **kwargs)
+        if desc is not None:
+            self.bar.show_title(desc)
+        self.interval = interval
+        self._manager = None
+        if processes:
+            self._manager = multiprocessing.Manager()
+            self.counter = _ProcessCounter(self._manager)
+        else:
+            self.counter = _ThreadCounter()
+        self._stop = threading.Event()
+        self._thread = None
+        if not self.bar.disable:
+            self._thread = threading.Thread(target=self._refresh_loop, name="MultiWorkerProgress")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def update(self, n=1):
+        self.counter.update(n)
+
+    def _refresh(self):
+        value = self.counter.value
+        if value != self.bar.n:
+            self.bar.update(value - self.bar.n)
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.interval):
+            self._refresh()
+
+    def close(self):
+        """
+        Stop refreshing, draw the final state and release the shared counter
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._refresh()
+        self.bar.close()
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
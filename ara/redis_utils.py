@@ -13,7 +13,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import redis
+from ara.import_utils import LazyModule
+
+redis = LazyModule("redis")
 
 
 class RedisConnection(object):
@@ -14,10 +14,11 @@ from __future__ import print_function
 
 import os
 
-import tensorflow as tf
+from ara.import_utils import LazyModule
 
-from keras.models import load_model
-from keras import backend as K
+tf = LazyModule("tensorflow")
+keras_models = LazyModule("keras.models")
+K = LazyModule("keras.backend")
 
 
 def freeze_session(session, keep_var_names=None, output_names=None, clear_devices=True):
@@ -57,7 +58,7 @@ def keras2pb(keras_model_path, output_path, pb_file_name):
     :param pb_file_name: Output pb file name
     :return: None
     """
-    model = load_model(keras_model_path)
+    model = keras_models.load_model(keras_model_path)
     frozen_graph = freeze_session(K.get_session(), output_names=[out.op.name for out in model.outputs])
     tf.train.write_graph(frozen_graph, output_path, pb_file_name, as_text=False)
 
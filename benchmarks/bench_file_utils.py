@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""=================================================
+@Project -> File   ：tools -> bench_file_utils.py
+@IDE    : Pycharm
+@Author : Qi Shuo
+@Date   : 2020-3-2
+@Intro  : Benchmarks of file_utils
+=================================================="""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from ara import file_utils
+
+
+def make_text_file(file_path, rows, cols, separator="\t"):
+    """
+    Write a synthetic delimited text file
+    :param file_path: Output file path
+    :param rows: Number of rows
+    :param cols: Number of columns
+    :param separator: Separator for each line
+    :return: None
+    """
+    with open(file_path, "w") as f:
+        for i in range(rows):
+            f.write(separator.join(str(i * cols + j) for j in range(cols)) + "\n")
+
+
+def measure(func, *args, **kwargs):
+    """
+    Run func once and measure it
+    :param func: Function to call
+    :return: [Wall time in seconds, peak traced memory in bytes]
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def consume(iterator):
+    for _ in iterator:
+        pass
+
+
+def bench_text_readers(file_path):
+    cases = [
+        ("read_text_file_to_list", file_utils.read_text_file_to_list, {"op": float}),
+        ("iter_text_file rows", lambda *a, **k: consume(file_utils.iter_text_file(*a, **k)), {"op": float}),
+        ("iter_text_file chunks", lambda *a, **k: consume(file_utils.iter_text_file(*a, **k)),
+         {"op": float, "chunk_size": 65536}),
+        ("iter_text_file numpy", lambda *a, **k: consume(file_utils.iter_text_file(*a, **k)),
+         {"chunk_size": 65536, "dtypes": "float64"}),
+        ("read_text_file_to_list_parallel", file_utils.read_text_file_to_list_parallel, {"op": float}),
+    ]
+    for name, func, kwargs in cases:
+        elapsed, peak = measure(func, file_path, **kwargs)
+        print("{:<32} {:>8.3f} s {:>10.1f} MB".format(name, elapsed, peak / 1024 / 1024))
+
+
+def bench_json(tmp_dir, records):
+    data = [{"id": i, "name": "item-{}".format(i), "values": [i * 0.5, i * 1.5]} for i in range(records)]
+    json_path = os.path.join(tmp_dir, "data.json")
+    lines_path = os.path.join(tmp_dir, "data.jsonl")
+    file_utils.write_json_lines(data, lines_path)
+    cases = [
+        ("write_dict_to_json_file", file_utils.write_dict_to_json_file, [data, json_path]),
+        ("write_dict_to_json_file stream", lambda *a: file_utils.write_dict_to_json_file(*a, stream=True),
+         [data, json_path]),
+        ("write_json_lines", file_utils.write_json_lines, [data, lines_path]),
+        ("read_json_file_to_dict", file_utils.read_json_file_to_dict, [json_path]),
+        ("iter_json_array", lambda *a: consume(file_utils.iter_json_array(*a)), [json_path]),
+        ("iter_json_lines", lambda *a: consume(file_utils.iter_json_lines(*a)), [lines_path]),
+    ]
+    print("json backend: {}".format("orjson" if file_utils.fast_json is not None else "json"))
+    for name, func, args in cases:
+        elapsed, peak = measure(func, *args)
+        print("{:<32} {:>8.3f} s {:>10.1f} MB".format(name, elapsed, peak / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--cols", type=int, default=8)
+    parser.add_argument("--json-records", type=int, default=200000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        text_path = os.path.join(tmp_dir, "data.tsv")
+        make_text_file(text_path, args.rows, args.cols)
+        bench_text_readers(text_path)
+        bench_json(tmp_dir, args.json_records)
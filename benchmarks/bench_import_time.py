@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""=================================================
+@Project -> File   ：tools -> bench_import_time.py
+@IDE    : Pycharm
+@Author : Qi Shuo
+@Date   : 2020-3-9
+@Intro  : Import time of ara modules, each measured in a fresh interpreter.
+          Exit code is 1 if a module is slower than --max-ms or loads a heavy dependency.
+=================================================="""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+MODULES = [
+    "ara",
+    "ara.advancedDS",
+    "ara.download_utils",
+    "ara.file_utils",
+    "ara.kafka_utils",
+    "ara.matrix_utils",
+    "ara.print_utils",
+    "ara.redis_utils",
+    "ara.tf_keras_utils",
+]
+
+HEAVY_MODULES = ["pandas", "sklearn", "scipy", "tensorflow", "keras", "kafka", "redis", "requests"]
+
+SNIPPET = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [name for name in {heavy} if name in sys.modules]]))
+"""
+
+
+def measure_import(module, repeat=5):
+    """
+    Import the module in fresh interpreters
+    :param module: Module name
+    :param repeat: Number of interpreters
+    :return: [Best import time in seconds, heavy modules loaded]
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    best, loaded = None, []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", SNIPPET.format(module=module, heavy=HEAVY_MODULES)], env=env)
+        elapsed, loaded = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        best = elapsed if best is None else min(best, elapsed)
+    return best, loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, default=300.0)
+    args = parser.parse_args()
+    failed = False
+    for module in MODULES:
+        elapsed, loaded = measure_import(module, repeat=args.repeat)
+        status = "ok"
+        if elapsed * 1000 > args.max_ms or len(loaded) > 0:
+            status = "REGRESSION"
+            failed = True
+        print("{:<22} {:>8.1f} ms  heavy: {:<20} {}".format(module, elapsed * 1000, ",".join(loaded) or "-", status))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""=================================================
+@Project -> File   ：tools -> bench_kafka_producer.py
+@IDE    : Pycharm
+@Author : Qi Shuo
+@Date   : 2020-4-2
+@Intro  : KafkaProducerRunner blocking vs asynchronous sending against a stand-in producer with broker latency
+=================================================="""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import argparse
+import threading
+
+from ara.kafka_utils import KafkaProducerRunner
+
+
+class FakeFuture(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def add_errback(self, errback):
+        pass
+
+    def success(self, metadata):
+        for callback in self.callbacks:
+            callback(metadata)
+        self.event.set()
+
+    def get(self, timeout=None):
+        self.event.wait(timeout)
+
+
+class FakeProducer(object):
+    """Buffers records like KafkaProducer, every request to the broker costs one round trip"""
+
+    def __init__(self, latency_ms=2.0, linger_ms=0, batch_size=16384, **kwargs):
+        self.latency = latency_ms / 1000
+        self.linger = linger_ms / 1000
+        self.batch_size = batch_size
+        self.condition = threading.Condition()
+        self.buffer, self.buffer_bytes, self.pending, self.requests = [], 0, 0, 0
+        self.closed = False
+        self.sender = threading.Thread(target=self._send_loop)
+        self.sender.daemon = True
+        self.sender.start()
+
+    def send(self, topic, key=None, value=None):
+        future = FakeFuture()
+        with self.condition:
+            self.buffer.append(future)
+            self.buffer_bytes += len(value)
+            self.pending += 1
+            self.condition.notify_all()
+        return future
+
+    def _send_loop(self):
+        while True:
+            with self.condition:
+                while not self.buffer and not self.closed:
+                    self.condition.wait()
+                if self.closed and not self.buffer:
+                    return
+                deadline = time.perf_counter() + self.linger
+                while self.buffer_bytes < self.batch_size and time.perf_counter() < deadline:
+                    self.condition.wait(deadline - time.perf_counter())
+                batch, self.buffer, self.buffer_bytes = self.buffer, [], 0
+            time.sleep(self.latency)
+            for future in batch:
+                future.success(None)
+            with self.condition:
+                self.pending -= len(batch)
+                self.requests += 1
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0, timeout)
+
+    def close(self, timeout=None):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.sender.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=200, help="Bytes per message")
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    parser.add_argument("--linger-ms", type=int, default=5)
+    args = parser.parse_args()
+    payload = b"x" * args.size
+    messages = [(str(i), payload) for i in range(args.messages)]
+
+    def factory(**kwargs):
+        return FakeProducer(latency_ms=args.latency_ms, **kwargs)
+
+    def report(name, runner, func):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print("{:<28} {:>8.3f} s {:>10.0f} msg/s {:>6} requests".format(
+            name, elapsed, args.messages / elapsed, runner.producer.requests))
+        runner.close()
+
+    runner = KafkaProducerRunner("localhost:9092", "bench", producer_factory=factory)
+    report("send_message", runner, lambda: [runner.send_message(key, value) for key, value in messages])
+    runner = KafkaProducerRunner("localhost:9092", "bench", producer_factory=factory)
+    report("send + flush linger=0", runner, lambda: runner.send_many(messages, flush=True))
+    runner = KafkaProducerRunner("localhost:9092", "bench", linger_ms=args.linger_ms, producer_factory=factory)
+    report("send + flush linger={}".format(args.linger_ms), runner, lambda: runner.send_many(messages, flush=True))
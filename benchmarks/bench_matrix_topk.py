@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""=================================================
+@Project -> File   ：tools -> bench_matrix_topk.py
+@IDE    : Pycharm
+@Author : Qi Shuo
+@Date   : 2020-3-16
+@Intro  : Blocked top-k search against the dense similarity matrix
+=================================================="""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+from ara import matrix_utils
+
+
+def dense_topk(matrix_a, matrix_b, k):
+    similarity = matrix_utils.calculate_matrix_cosine_similarity(matrix_a, matrix_b)
+    index = np.argsort(-similarity, axis=1)[:, :k]
+    return index, np.take_along_axis(similarity, index, axis=1)
+
+
+def measure(func, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--gallery", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--block-size", type=int, default=4096)
+    parser.add_argument("--max-workers", type=int, default=4)
+    args = parser.parse_args()
+    rng = np.random.RandomState(0)
+    queries = rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    gallery = rng.standard_normal((args.gallery, args.dim)).astype(np.float32)
+
+    (dense_index, _), elapsed, peak = measure(dense_topk, queries, gallery, args.k)
+    print("{:<24} {:>8.3f} s {:>10.1f} MB".format("dense", elapsed, peak / 1024 / 1024))
+    for max_workers in [None, args.max_workers]:
+        (index, _), elapsed, peak = measure(matrix_utils.calculate_matrix_topk, queries, gallery, k=args.k,
+                                            block_size=args.block_size, query_block_size=args.block_size,
+                                            max_workers=max_workers)
+        name = "topk workers={}".format(max_workers or 1)
+        print("{:<24} {:>8.3f} s {:>10.1f} MB  agreement {:.4f}".format(
+            name, elapsed, peak / 1024 / 1024, (index == dense_index).mean()))
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+"""=================================================
+@Project -> File   ：tools -> bench_matrix_utils.py
+@IDE    : Pycharm
+@Author : Qi Shuo
+@Date   : 2020-3-30
+@Intro  : Wall time and peak memory of matrix_utils over shapes, dtypes, axes and dense/sparse inputs.
+          python benchmarks/bench_matrix_utils.py --output baseline.json
+          python benchmarks/bench_matrix_utils.py --compare baseline.json --threshold 0.2
+=================================================="""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+import numpy as np
+import scipy.sparse as sp
+
+from ara import matrix_utils
+
+SHAPES = {
+    "tall": (20000, 64),
+    "wide": (64, 20000),
+    "square": (1000, 1000),
+}
+DTYPES = ["float32", "float64"]
+FORMATS = ["dense", "sparse"]
+SPARSE_DENSITY = 0.01
+
+
+def axis_cases():
+    """
+    Functions taking (matrix, axis)
+    :return: List of [name, function, supports sparse]
+    """
+    return [
+        ["matrix_normalization", lambda x, axis: matrix_utils.matrix_normalization(x, axis=axis), True],
+        ["matrix_standardization", lambda x, axis: matrix_utils.matrix_standardization(
+            x, axis=axis, with_mean=not sp.issparse(x)), True],
+        ["matrix_regularization", lambda x, axis: matrix_utils.matrix_regularization(x, axis=axis), True],
+        ["missing_value_processing", lambda x, axis: matrix_utils.missing_value_processing(x, axis=axis), False],
+    ]
+
+
+def matrix_cases():
+    """
+    Functions taking (matrix)
+    :return: List of [name, function, supports sparse]
+    """
+    def cross(x):
+        return x, x[:min(x.shape[0], 500)]
+
+    def ivf_search(x):
+        index = matrix_utils.IVFIndex(n_lists=max(1, min(64, x.shape[0] // 40)), n_probe=4)
+        index.train(x, n_iter=5)
+        index.add(x)
+        return index.search(cross(x)[1], k=10)
+
+    def quantizer_search(quantizer, x):
+        quantizer.fit(x)
+        return quantizer.search(cross(x)[1], quantizer.encode(x), k=10)
+
+    def quantization_report(x):
+        quantizer = matrix_utils.ScalarQuantizer("int8").fit(x)
+        return matrix_utils.quantization_report(quantizer, cross(x)[1], x, k=10)
+
+    return [
+        ["matrix_binarization", lambda x: matrix_utils.matrix_binarization(x), True],
+        ["calculate_row_norms", lambda x: matrix_utils.calculate_row_norms(x), True],
+        ["calculate_paired_cosine_similarity",
+         lambda x: matrix_utils.calculate_paired_cosine_similarity(x, x), True],
+        ["calculate_paired_euclidean_distance",
+         lambda x: matrix_utils.calculate_paired_euclidean_distance(x, x), True],
+        ["calculate_vector_euclidean_distance",
+         lambda x: matrix_utils.calculate_vector_euclidean_distance(x, x), False],
+        ["calculate_matrix_cosine_similarity",
+         lambda x: matrix_utils.calculate_matrix_cosine_similarity(*cross(x)), True],
+        ["calculate_matrix_euclidean_distance",
+         lambda x: matrix_utils.calculate_matrix_euclidean_distance(*cross(x)), True],
+        ["calculate_matrix_topk", lambda x: matrix_utils.calculate_matrix_topk(*cross(x), k=10), True],
+        ["VectorReference", lambda x: matrix_utils.VectorReference(x).cosine_similarity(cross(x)[1]), True],
+        ["StreamingStandardizer", lambda x: matrix_utils.StreamingStandardizer().partial_fit(x).transform(
+            x, with_mean=not sp.issparse(x)), True],
+        ["MissingValueImputer", lambda x: matrix_utils.MissingValueImputer("median").fit_transform(x), False],
+        ["IVFIndex", ivf_search, False],
+        ["ScalarQuantizer", lambda x: quantizer_search(matrix_utils.ScalarQuantizer("int8"), x), False],
+        ["ProductQuantizer", lambda x: quantizer_search(matrix_utils.ProductQuantizer(
+            n_subvectors=max(m for m in range(1, 9) if x.shape[1] % m == 0), n_centroids=min(256, x.shape[0])), x), False],
+        ["quantization_report", quantization_report, False],
+    ]
+
+
+def vector_cases(n):
+    """
+    Functions on vectors and categorical columns
+    :param n: Vector length
+    :return: List of [name, function(no argument)]
+    """
+    rng = np.random.RandomState(0)
+    a, b = rng.rand(n), rng.rand(n)
+    categories = rng.randint(0, 1000, n).astype(str)
+    return [
+        ["calculate_vector_cosine_similarity", lambda: matrix_utils.calculate_vector_cosine_similarity(a, b)],
+        ["label_encoder", lambda: matrix_utils.label_encoder(categories)],
+        ["one_hot_encoder", lambda: matrix_utils.one_hot_encoder(categories, sparse=True)],
+        ["VocabularyEncoder", lambda: matrix_utils.VocabularyEncoder().fit_transform(categories)],
+    ]
+
+
+def make_matrix(shape, dtype, matrix_format, seed=0):
+    rng = np.random.RandomState(seed)
+    if matrix_format == "sparse":
+        return sp.random(shape[0], shape[1], density=SPARSE_DENSITY, format="csr", dtype=dtype, random_state=rng)
+    return rng.rand(*shape).astype(dtype)
+
+
+def measure(func, repeat=3):
+    """
+    :param func: Function without argument
+    :param repeat: Number of timed runs
+    :return: [Best wall time in seconds, peak traced memory in bytes]
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # A separate run for memory, tracing slows the code down
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def run(repeat=3, scale=1.0, only=None):
+    """
+    Run the benchmark grid
+    :param repeat: Number of timed runs per case
+    :param scale: Multiplier of the number of rows/columns
+    :param only: Substring filter on function names
+    :return: List of result dicts
+    """
+    results = []
+
+    def record(name, func, **params):
+        if only is not None and only not in name:
+            return
+        try:
+            seconds, peak = measure(func, repeat=repeat)
+        except Exception as e:
+            # Kept in the results so a baseline case that starts failing is reported
+            print("\033[1;33;0mERROR : {} {} {}\033[0m".format(name, params, e))
+            results.append(dict(name=name, seconds=None, peak_bytes=None, error=str(e), **params))
+            return
+        result = dict(name=name, seconds=seconds, peak_bytes=peak, **params)
+        results.append(result)
+        print("{:<38} {:<48} {:>9.4f} s {:>9.1f} MB".format(
+            name, json.dumps(params, sort_keys=True), seconds, peak / 1024 / 1024))
+
+    for shape_name, shape in SHAPES.items():
+        shape = (max(1, int(shape[0] * scale)), max(1, int(shape[1] * scale)))
+        for dtype in DTYPES:
+            for matrix_format in FORMATS:
+                matrix = make_matrix(shape, dtype, matrix_format)
+                params = dict(shape=shape_name, rows=shape[0], cols=shape[1], dtype=dtype, format=matrix_format)
+                for name, func, supports_sparse in axis_cases():
+                    if matrix_format == "sparse" and not supports_sparse:
+                        continue
+                    for axis in [0, 1]:
+                        record(name, lambda: func(matrix, axis), axis=axis, **params)
+                for name, func, supports_sparse in matrix_cases():
+                    if matrix_format == "sparse" and not supports_sparse:
+                        continue
+                    record(name, lambda: func(matrix), **params)
+    for name, func in vector_cases(max(1, int(100000 * scale))):
+        record(name, func, shape="vector", rows=max(1, int(100000 * scale)))
+    return results
+
+
+def result_key(result):
+    return json.dumps({key: value for key, value in result.items() if key not in ("seconds", "peak_bytes", "error")},
+                      sort_keys=True)
+
+
+def compare(results, baseline, threshold=0.2, min_seconds=1e-3, only=None):
+    """
+    Flag results slower or heavier than the baseline by more than threshold, and baseline cases
+    missing from the results or failing now
+    :param results: Current results
+    :param baseline: Baseline results
+    :param threshold: Relative tolerance
+    :param min_seconds: Cases faster than this in both runs are not compared on time(timer noise)
+    :param only: Substring filter on function names the results were run with
+    :return: List of regression messages
+    """
+    results = {result_key(result): result for result in results}
+    regressions = []
+    for base in baseline:
+        if base.get("error") is not None or (only is not None and only not in base["name"]):
+            continue
+        result = results.get(result_key(base))
+        if result is None:
+            regressions.append("{} {}: missing".format(base["name"], result_key(base)))
+            continue
+        if result.get("error") is not None:
+            regressions.append("{} {}: failing, {}".format(base["name"], result_key(base), result["error"]))
+            continue
+        if max(result["seconds"], base["seconds"]) >= min_seconds and \
+                result["seconds"] > base["seconds"] * (1 + threshold):
+            regressions.append("{} {}: time {:.4f}s -> {:.4f}s".format(
+                result["name"], result_key(result), base["seconds"], result["seconds"]))
+        if result["peak_bytes"] > base["peak_bytes"] * (1 + threshold) + 1024 * 1024:
+            regressions.append("{} {}: peak memory {:.1f}MB -> {:.1f}MB".format(
+                result["name"], result_key(result), base["peak_bytes"] / 1024 / 1024,
+                result["peak_bytes"] / 1024 / 1024))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--only", default=None, help="Only run functions whose name contains this")
+    parser.add_argument("--output", default=None, help="Write the results to this json file")
+    parser.add_argument("--compare", default=None, help="Baseline json file")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+    current = run(repeat=args.repeat, scale=args.scale, only=args.only)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__, "results": current}, f,
+                      indent=1)
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            found = compare(current, json.load(f)["results"], threshold=args.threshold, only=args.only)
+        for message in found:
+            print("\033[1;31;0mREGRESSION : {}\033[0m".format(message))
+        print("{} regressions".format(len(found)))
+        sys.exit(1 if found else 0)
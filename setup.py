@@ -4,4 +4,5 @@ setup(
     name="ara",
     version="0.0.2",
     packages=find_packages(),
+    python_requires=">=3.7",
 )
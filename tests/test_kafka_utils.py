@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+
+"""=================================================
+@Project -> File   ：tools -> test_kafka_utils.py
+@IDE    : Pycharm
+@Author : Qi Shuo
+@Date   : 2020-4-6
+@Intro  : Kafka runners against in-process fake clients
+=================================================="""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+import collections
+
+from ara.kafka_utils import KafkaConsumerRunner, KafkaProducerRunner, KafkaMetrics
+
+try:
+    import kafka
+except ImportError:
+    kafka = None
+
+TopicPartition = collections.namedtuple("TopicPartition", ["topic", "partition"])
+FakeRecord = collections.namedtuple("FakeRecord", ["offset", "key", "value", "serialized_key_size",
+                                                   "serialized_value_size"])
+
+
+class FakeConsumer(object):
+    """In-process stand-in of KafkaConsumer
+
+    Attributes:
+        records: {TopicPartition: deque of FakeRecord} not polled yet
+        per_poll: Max records returned per partition by one poll
+        commits: {TopicPartition: last committed offset}
+        revoke_at: [poll number, TopicPartition] revoked inside that poll, or None
+        events: Commits and revocations in order
+    """
+
+    def __init__(self, n_records, n_partitions=1, per_poll=10, topic="topic", revoke_at=None):
+        self.records = collections.OrderedDict()
+        for partition in range(n_partitions):
+            tp = TopicPartition(topic, partition)
+            self.records[tp] = collections.deque(
+                FakeRecord(offset, b"k", "{}-{}".format(partition, offset).encode("utf-8"), 1, 8)
+                for offset in range(n_records))
+        self.per_poll = per_poll
+        self.revoke_at = revoke_at
+        self.lock = threading.Lock()
+        self.assigned = set(self.records)
+        self.paused_partitions = set()
+        self.commits = {}
+        self.events = []
+        self.polls = 0
+        self.listener = None
+
+    def subscribe(self, topics=None, listener=None):
+        self.listener = listener
+
+    def assignment(self):
+        return set(self.assigned)
+
+    def pause(self, *partitions):
+        self.paused_partitions.update(partitions)
+
+    def resume(self, *partitions):
+        self.paused_partitions.difference_update(partitions)
+
+    def paused(self):
+        return set(self.paused_partitions)
+
+    def highwater(self, tp):
+        return None
+
+    def poll(self, timeout_ms=0, max_records=500):
+        with self.lock:
+            self.polls += 1
+            if self.revoke_at is not None and self.polls == self.revoke_at[0]:
+                tp = self.revoke_at[1]
+                self.events.append("revoked")
+                self.listener.on_partitions_revoked([tp])
+                self.assigned.discard(tp)
+                del self.records[tp]
+            msg_pack = {}
+            for tp, records in self.records.items():
+                if tp in self.paused_partitions:
+                    continue
+                n = min(len(records), self.per_poll, max_records - sum(map(len, msg_pack.values())))
+                if n > 0:
+                    msg_pack[tp] = [records.popleft() for _ in range(n)]
+        if not msg_pack:
+            time.sleep(timeout_ms / 1000)
+        return msg_pack
+
+    def commit(self, offsets):
+        with self.lock:
+            offsets = {tp: offset_and_metadata.offset for tp, offset_and_metadata in offsets.items()}
+            self.commits.update(offsets)
+            self.events.append(offsets)
+
+    def close(self):
+        pass
+
+
+class FakeFuture(object):
+    """Stand-in of FutureRecordMetadata resolved by the test"""
+
+    def __init__(self):
+        self.callbacks = []
+        self.errbacks = []
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def add_errback(self, errback):
+        self.errbacks.append(errback)
+
+    def success(self, metadata):
+        for callback in self.callbacks:
+            callback(metadata)
+
+    def failure(self, exception):
+        for errback in self.errbacks:
+            errback(exception)
+
+
+class FakeProducer(object):
+    """Stand-in of KafkaProducer keeping what was sent
+
+    Attributes:
+        sent: [topic, key, value, FakeFuture] per send()
+        flushes: Timeout of each flush()
+    """
+
+    def __init__(self, **configs):
+        self.sent = []
+        self.flushes = []
+
+    def send(self, topic, key=None, value=None):
+        future = FakeFuture()
+        self.sent.append([topic, key, value, future])
+        return future
+
+    def flush(self, timeout=None):
+        self.flushes.append(timeout)
+
+    def close(self, timeout=None):
+        pass
+
+
+class RecordingRunner(KafkaConsumerRunner):
+    """Keeps the batches it processed, fails the batch holding fail_offset of fail_partition
+
+    failed_from is {partition: first offset} of the failed batch, failed_size its number of records
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+        self.fail_partition, self.fail_offset, self.failed_from, self.failed_size = None, None, None, 0
+        super(RecordingRunner, self).__init__(*args, **kwargs)
+
+    def process_batch(self, topics, partitions, offsets, keys, values):
+        rows = list(zip(partitions, offsets))
+        if (self.fail_partition, self.fail_offset) in rows:
+            self.failed_from, self.failed_size = {}, len(rows)
+            for partition, offset in rows:
+                self.failed_from[partition] = min(offset, self.failed_from.get(partition, offset))
+            raise RuntimeError("failed on purpose")
+        self.batches.append([rows, list(values)])
+
+
+class FileRunner(KafkaConsumerRunner):
+    """Worker processes append "pid partition offset value" lines to a file per process"""
+
+    def __init__(self, output_dir, *args, **kwargs):
+        self.output_dir = output_dir
+        super(FileRunner, self).__init__(*args, **kwargs)
+
+    def process_batch(self, topics, partitions, offsets, keys, values):
+        with open(os.path.join(self.output_dir, "{}.txt".format(os.getpid())), "a") as f:
+            for partition, offset, value in zip(partitions, offsets, values):
+                f.write("{} {} {} {}\n".format(os.getpid(), partition, offset, bytes(value).decode("utf-8")))
+
+
+class ExitingRunner(KafkaConsumerRunner):
+    """The worker process getting exit_offset exits without a word"""
+
+    def __init__(self, exit_offset, *args, **kwargs):
+        self.exit_offset = exit_offset
+        super(ExitingRunner, self).__init__(*args, **kwargs)
+
+    def process_batch(self, topics, partitions, offsets, keys, values):
+        if self.exit_offset in offsets:
+            os._exit(3)
+
+
+def run_until(runner, condition, timeout=10.0):
+    """
+    Run the runner in a thread until condition() is true, then stop it
+    :return: Whether the condition was met before the timeout
+    """
+    thread = threading.Thread(target=runner.run)
+    thread.daemon = True
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    met = condition()
+    runner.stop()
+    thread.join(timeout)
+    assert not thread.is_alive(), "runner did not stop"
+    return met
+
+
+@unittest.skipIf(kafka is None, "kafka-python is not installed")
+class TestBatching(unittest.TestCase):
+
+    def test_batch_closes_at_max_records(self):
+        consumer = FakeConsumer(250, per_poll=30)
+        runner = RecordingRunner("fake", "group", ["topic"], 1, batch_max_records=100, batch_timeout_ms=60000,
+                                 consumer_factory=lambda **configs: consumer)
+        self.assertTrue(run_until(runner, lambda: len(runner.batches) >= 2))
+        sizes = [len(rows) for rows, _ in runner.batches]
+        self.assertEqual(sizes[:2], [100, 100])
+        # The rest is processed on stop
+        self.assertEqual(sum(sizes), 250)
+        offsets = [offset for rows, _ in runner.batches for _, offset in rows]
+        self.assertEqual(offsets, list(range(250)))
+
+    def test_default_processes_each_poll(self):
+        consumer = FakeConsumer(3, per_poll=1)
+        runner = RecordingRunner("fake", "group", ["topic"], 1, batch_max_records=100,
+                                 consumer_factory=lambda **configs: consumer)
+        self.assertTrue(run_until(runner, lambda: len(runner.batches) >= 3))
+        # Without batch_timeout_ms no poll result waits for the next one
+        self.assertEqual([len(rows) for rows, _ in runner.batches], [1, 1, 1])
+
+    def test_batch_closes_at_timeout(self):
+        consumer = FakeConsumer(3, per_poll=1)
+        runner = RecordingRunner("fake", "group", ["topic"], 1, poll_timeout_ms=10, batch_max_records=100,
+                                 batch_timeout_ms=50, consumer_factory=lambda **configs: consumer)
+        started = time.monotonic()
+        self.assertTrue(run_until(runner, lambda: len(runner.batches) >= 1))
+        self.assertLess(time.monotonic() - started, 2.0)
+        self.assertEqual([len(rows) for rows, _ in runner.batches], [3])
+        self.assertEqual(runner.batches[0][1], [b"0-0", b"0-1", b"0-2"])
+
+
+@unittest.skipIf(kafka is None, "kafka-python is not installed")
+class TestPipelined(unittest.TestCase):
+
+    def test_commits_stop_at_failed_batch(self):
+        consumer = FakeConsumer(300, n_partitions=2, per_poll=10)
+        runner = RecordingRunner("fake", "group", ["topic"], 4, batch_max_records=40, batch_timeout_ms=20,
+                                 consumer_factory=lambda **configs: consumer, mode="pipelined", max_in_flight=2,
+                                 commit_interval_ms=10)
+        runner.fail_partition, runner.fail_offset = 0, 100
+        processed = lambda: sum(len(rows) for rows, _ in runner.batches)
+        self.assertTrue(run_until(runner, lambda: runner.failed_from is not None and
+                                  processed() + runner.failed_size == 600))
+        # Each partition is committed up to its first record in the failed batch, later batches succeeded
+        for partition in range(2):
+            first = runner.failed_from.get(partition, 300)
+            self.assertEqual(consumer.commits[TopicPartition("topic", partition)], first)
+        self.assertLessEqual(runner.failed_from[0], 100)
+
+    def test_revoked_partition_is_not_committed(self):
+        revoked = TopicPartition("topic", 0)
+        consumer = FakeConsumer(40, n_partitions=2, per_poll=7, revoke_at=[3, revoked])
+        runner = RecordingRunner("fake", "group", ["topic"], 2, batch_max_records=100, batch_timeout_ms=500,
+                                 consumer_factory=lambda **configs: consumer, mode="pipelined",
+                                 commit_interval_ms=10)
+        self.assertTrue(run_until(runner, lambda: consumer.commits.get(TopicPartition("topic", 1)) == 40))
+        after_revoke = consumer.events[consumer.events.index("revoked") + 1:]
+        self.assertTrue(all(revoked not in offsets for offsets in after_revoke))
+        self.assertTrue(all(partition == 1 for rows, _ in runner.batches for partition, _ in rows))
+
+
+@unittest.skipIf(kafka is None, "kafka-python is not installed")
+class TestProcessMode(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_partition_order_is_kept(self):
+        n_records, n_partitions = 500, 6
+        consumer = FakeConsumer(n_records, n_partitions=n_partitions, per_poll=13)
+        runner = FileRunner(self.output_dir, "fake", "group", ["topic"], 3, batch_max_records=50,
+                            batch_timeout_ms=20, consumer_factory=lambda **configs: consumer, mode="process",
+                            max_in_flight=4, commit_interval_ms=10)
+        total = n_records * n_partitions
+        self.assertTrue(run_until(runner, lambda: sum(consumer.commits.values()) == total, timeout=30))
+        offsets, owners = collections.defaultdict(list), collections.defaultdict(set)
+        for name in os.listdir(self.output_dir):
+            with open(os.path.join(self.output_dir, name)) as f:
+                for line in f:
+                    pid, partition, offset, value = line.split()
+                    offsets[int(partition)].append(int(offset))
+                    owners[int(partition)].add(pid)
+                    self.assertEqual(value, "{}-{}".format(partition, offset))
+        for partition in range(n_partitions):
+            self.assertEqual(offsets[partition], list(range(n_records)))
+            self.assertEqual(len(owners[partition]), 1)
+
+    def test_dead_worker_stops_runner(self):
+        consumer = FakeConsumer(1000, per_poll=10)
+        runner = ExitingRunner(50, "fake", "group", ["topic"], 2, batch_max_records=20, batch_timeout_ms=20,
+                               consumer_factory=lambda **configs: consumer, mode="process", commit_interval_ms=10)
+        errors = []
+
+        def target():
+            try:
+                runner.run()
+            except RuntimeError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), "runner did not stop")
+        self.assertEqual(len(errors), 1)
+        self.assertRegex(str(errors[0]), r"^Worker \d exited with code 3$")
+        # Nothing from the batch the worker died on is committed
+        self.assertLessEqual(consumer.commits.get(TopicPartition("topic", 0), 0), 50)
+
+
+class TestProducer(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = KafkaProducerRunner("fake", "topic", producer_factory=FakeProducer)
+        self.producer = self.runner.producer
+
+    def test_send_callback(self):
+        delivered = []
+        future = self.runner.send("k", "value", callback=delivered.append, errback=self.fail)
+        self.assertEqual(self.producer.sent[0][:3], ["topic", b"k", b"value"])
+        self.assertEqual(self.runner.metrics.values["producer_pending"][()], 1)
+        future.success("metadata")
+        self.assertEqual(delivered, ["metadata"])
+        values = self.runner.metrics.values
+        self.assertEqual(values["producer_pending"][()], 0)
+        self.assertEqual(values["producer_records_total"][("topic",)], 1)
+        self.assertEqual(values["producer_bytes_total"][("topic",)], 6)
+
+    def test_send_errback(self):
+        failed = []
+        error = RuntimeError("broker down")
+        self.runner.send("k", "value", callback=self.fail, errback=failed.append).failure(error)
+        self.assertEqual(failed, [error])
+        values = self.runner.metrics.values
+        self.assertEqual(values["producer_pending"][()], 0)
+        self.assertEqual(values["producer_errors_total"][("topic",)], 1)
+        self.assertNotIn(("topic",), values["producer_records_total"])
+
+    def test_send_many(self):
+        delivered, failed = [], []
+        futures = self.runner.send_many([(None, "a"), ("k", 1), ("k", None)], callback=delivered.append,
+                                        errback=failed.append, flush=True, timeout=5)
+        self.assertEqual([sent[1:3] for sent in self.producer.sent], [[None, b"a"], [b"k", b"1"], [b"k", None]])
+        self.assertEqual(self.producer.flushes, [5])
+        futures[0].success(0)
+        futures[1].failure(ValueError())
+        futures[2].success(2)
+        self.assertEqual(delivered, [0, 2])
+        self.assertEqual(len(failed), 1)
+
+    def test_binary_values_pass_through(self):
+        values = [b"bytes", bytearray(b"bytearray"), memoryview(b"memoryview")]
+        for value in values:
+            self.runner.send(value, value)
+        for value, sent in zip(values, self.producer.sent):
+            # No copy is made of values that are already binary
+            self.assertIs(sent[1], value)
+            self.assertIs(sent[2], value)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_snapshot(self):
+        metrics = KafkaMetrics()
+        metrics.inc("consumer_records_total", 3, ("topic", 0))
+        metrics.inc("consumer_records_total", 2, ("topic", 0))
+        metrics.set("consumer_lag", 7, ("topic", 0))
+        metrics.set("consumer_lag", 4, ("topic", 0))
+        for value in [0.001, 0.005, 0.02, 20.0]:
+            metrics.observe("consumer_process_seconds", value)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["values"]["consumer_records_total"], {("topic", 0): 5})
+        self.assertEqual(snapshot["values"]["consumer_lag"], {("topic", 0): 4})
+        histogram = snapshot["histograms"]["consumer_process_seconds"][()]
+        self.assertEqual(histogram["count"], 4)
+        self.assertAlmostEqual(histogram["sum"], 20.026)
+        buckets = dict(histogram["buckets"])
+        # Bounds are inclusive and counts cumulative
+        self.assertEqual([buckets[0.001], buckets[0.005], buckets[0.025], buckets[10.0], buckets[float("inf")]],
+                         [1, 2, 3, 3, 4])
+
+    def test_rates_and_callback(self):
+        reports = []
+        metrics = KafkaMetrics(callback=reports.append, interval=60.0)
+        metrics.inc("producer_records_total", 10, ("topic",))
+        metrics.maybe_report()
+        self.assertEqual(reports, [])
+        metrics.window[0] -= 2.0
+        metrics.next_report = 0
+        metrics.maybe_report()
+        self.assertEqual(len(reports), 1)
+        self.assertAlmostEqual(reports[0]["rates"]["producer_records_total"][("topic",)], 5.0, places=1)
+        # The next window only counts what was added since
+        metrics.inc("producer_records_total", 4, ("topic",))
+        metrics.window[0] -= 2.0
+        metrics.next_report = 0
+        metrics.maybe_report()
+        self.assertAlmostEqual(reports[1]["rates"]["producer_records_total"][("topic",)], 2.0, places=1)
+
+    def test_to_prometheus(self):
+        metrics = KafkaMetrics(buckets=(0.01, 0.1))
+        metrics.inc("consumer_records_total", 3, ('a"b', 0))
+        metrics.set("consumer_queue_depth", 2)
+        metrics.observe("consumer_process_seconds", 0.05)
+        metrics.observe("consumer_process_seconds", 0.5)
+        lines = metrics.to_prometheus().splitlines()
+        self.assertIn("# HELP ara_kafka_consumer_records_total Records polled", lines)
+        self.assertIn("# TYPE ara_kafka_consumer_records_total counter", lines)
+        self.assertIn('ara_kafka_consumer_records_total{topic="a\\"b",partition="0"} 3', lines)
+        self.assertIn("# TYPE ara_kafka_consumer_queue_depth gauge", lines)
+        self.assertIn("ara_kafka_consumer_queue_depth 2", lines)
+        start = lines.index("# TYPE ara_kafka_consumer_process_seconds histogram")
+        self.assertEqual(lines[start + 1:start + 6], [
+            'ara_kafka_consumer_process_seconds_bucket{le="0.01"} 0',
+            'ara_kafka_consumer_process_seconds_bucket{le="0.1"} 1',
+            'ara_kafka_consumer_process_seconds_bucket{le="+Inf"} 2',
+            "ara_kafka_consumer_process_seconds_sum 0.55",
+            "ara_kafka_consumer_process_seconds_count 2"])
+        self.assertTrue(metrics.to_prometheus(prefix="x_").startswith("# HELP x_"))
+
+
+if __name__ == "__main__":
+    unittest.main()